@@ -8,8 +8,11 @@ import train_pipeline
 import evaluate_models
 #import conllutools
 import lemmatizer_pipeline
+import lemmatizer_server
+import profiler
+import model_api
 from command_parser import parse_prefix
-from preferences import Paths, __version__, Tokenizer, Context
+from preferences import Paths, __version__, Tokenizer, Context, Cache
 
 div = '‹<>›'*16
 
@@ -62,6 +65,45 @@ def get_args():
         '--use-cpu', action='store_true')
     ap.add_argument(
         '--preserve-numbers', action='store_true')
+    ap.add_argument(
+        '--no-cache', action='store_true')
+    ap.add_argument(
+        '--workers', type=int, default=1)
+    ap.add_argument(
+        '--backend', type=str, default='onmt',
+        choices=list(model_api.BACKENDS))
+    ap.add_argument(
+        '--greedy-tagger', action='store_true')
+    ap.add_argument(
+        '--chunk-size', type=int)
+    ap.add_argument(
+        '--columnar', action='store_true')
+    ap.add_argument(
+        '--stream', action='store_true')
+    ap.add_argument(
+        '--input-dir', type=str)
+    ap.add_argument(
+        '--glob', type=str)
+    ap.add_argument(
+        '--serve', type=str)
+    ap.add_argument(
+        '--port', type=int)
+    ap.add_argument(
+        '--max-latency', type=float)
+    ap.add_argument(
+        '--jobs', type=int, default=1)
+    ap.add_argument(
+        '--slots', type=int)
+    ap.add_argument(
+        '--threads', type=int)
+    ap.add_argument(
+        '--shared-vocab', action='store_true')
+    ap.add_argument(
+        '--profile', type=str)
+    ap.add_argument(
+        '--profile-python', action='store_true')
+    ap.add_argument(
+        '--profile-memory', action='store_true')
     return ap.parse_args()
 
 
@@ -76,6 +118,13 @@ if __name__ == "__main__":
         Paths.conllu = args.conllu_path
     if args.model_path:
         Paths.models = args.model_path
+    if args.no_cache:
+        Cache.predictions = False
+        Cache.tokens = False
+    if args.profile:
+        profiler.enable(args.profile,
+                        python=args.profile_python,
+                        memory_use=args.profile_memory)
 
     if args.tokenizer > 2:
         print('> Invalid tokenization setting')
@@ -86,28 +135,33 @@ if __name__ == "__main__":
     if args.train:
         models = parse_prefix(args.train, train=True)
         train_pipeline.train_model(
-            *models, cpu=args.use_cpu)
+            *models, cpu=args.use_cpu,
+            slots=args.slots, threads=args.threads,
+            shared_vocab=args.shared_vocab)
     elif args.build:
         Tokenizer.setting = args.tokenizer
         Context.lemmatizer_context = args.lemmatizer_context
         Context.tagger_context = args.tagger_context
         models = parse_prefix(args.build, build=True)
         train_pipeline.build_train_data(
-            *models)
+            *models, jobs=args.jobs)
     elif args.build_train:
         Tokenizer.setting = args.tokenizer
         Context.lemmatizer_context = args.lemmatizer_context
         Context.tagger_context = args.tagger_context        
         models = parse_prefix(args.build_train, build=True)
         train_pipeline.build_train_data(
-            *models)
+            *models, jobs=args.jobs)
         train_pipeline.train_model(
-            *models, cpu=args.use_cpu)
+            *models, cpu=args.use_cpu,
+            slots=args.slots, threads=args.threads,
+            shared_vocab=args.shared_vocab)
     elif args.evaluate:
         models = parse_prefix(
             args.evaluate, evaluate=True)
         evaluate_models.pipeline(
-            *models, cpu=args.use_cpu)
+            *models, cpu=args.use_cpu, workers=args.workers,
+            backend=args.backend, greedy_tagger=args.greedy_tagger)
     elif args.evaluate_fast:
          models = parse_prefix(
              args.evaluate_fast, evaluate=True)
@@ -115,16 +169,43 @@ if __name__ == "__main__":
              *models, cpu=args.use_cpu, fast=True)
          #elif args.normalize_conllu:
          #   conllutools.normalize_all('conllu')
+    elif args.serve:
+        engine = model_api.TranslatorEngine(
+            args.use_cpu, workers=args.workers, backend=args.backend,
+            greedy_tagger=args.greedy_tagger)
+        lemmatizer_server.serve(
+            args.serve, engine,
+            ignore_numbers=not args.preserve_numbers,
+            port=args.port,
+            max_latency=args.max_latency)
     elif args.lemmatize:
         cpu = args.use_cpu
         if args.preserve_numbers:
             ignore_nums = False
         else:
             ignore_nums = True
-        lemmatizer = lemmatizer_pipeline.Lemmatizer(
-            args.filename,
-            fast=False,
-            ignore_numbers=ignore_nums)
         model = args.lemmatize
-        lemmatizer.run_model(model, cpu)                                        
+        if (args.input_dir or args.glob) and\
+           (args.chunk_size is not None or args.stream):
+            print('> --chunk-size and --stream cannot be used with '\
+                  '--input-dir or --glob')
+            sys.exit(1)
+        engine = model_api.TranslatorEngine(
+            cpu, workers=args.workers, backend=args.backend,
+            greedy_tagger=args.greedy_tagger)
+        if args.input_dir or args.glob:
+            filenames = lemmatizer_pipeline.plan_files(
+                args.input_dir, args.glob)
+            lemmatizer_pipeline.run_batch(
+                filenames, model, cpu, engine,
+                ignore_numbers=ignore_nums,
+                columnar=args.columnar)
+        else:
+            lemmatizer = lemmatizer_pipeline.Lemmatizer(
+                args.filename,
+                fast=False,
+                ignore_numbers=ignore_nums,
+                columnar=args.columnar)
+            lemmatizer.run_model(
+                model, cpu, engine, args.chunk_size, stream=args.stream)                                        
         
@@ -0,0 +1,108 @@
+import os
+import random
+import tarfile
+from collections import Counter
+
+""" ===========================================================
+Synthetic corpora for BabyLemmatizer benchmarks
+
+Corpora are sampled from the training data of a packed data set
+(e.g. conllu/lbtest1.tar.gz). Word lines are drawn from the `vocab`
+most frequent forms with their real frequencies, and segment
+lengths follow the real segment length distribution, so that
+corpus size and vocabulary size can be varied independently.
+
+=========================================================== """
+
+
+def read_tarball(tarball, suffix='-train.conllu'):
+    """ Read segments of a CoNLL-U file packed into a tarball
+
+    :param tarball         .tar.gz file
+    :param suffix          member name suffix
+
+    :type tarball          str / path
+    :type suffix           str
+
+    Returns a list of segments, each a list of word lines. """
+
+    segments = []
+    with tarfile.open(tarball, 'r:gz') as tar:
+        for member in tar.getmembers():
+            if not member.name.endswith(suffix):
+                continue
+            f = tar.extractfile(member)
+            words = []
+            for line in f.read().decode('utf-8').splitlines():
+                if line.startswith('#'):
+                    continue
+                if line.strip():
+                    words.append(line.split('\t'))
+                elif words:
+                    segments.append(words)
+                    words = []
+            if words:
+                segments.append(words)
+    return segments
+
+
+def extract(tarball, path):
+    """ Extract the CoNLL-U files of a tarball into `path` """
+    with tarfile.open(tarball, 'r:gz') as tar:
+        for member in tar.getmembers():
+            if not member.name.endswith('.conllu'):
+                continue
+            filename = os.path.join(path, os.path.basename(member.name))
+            with open(filename, 'wb') as f:
+                f.write(tar.extractfile(member).read())
+
+
+def make_corpus(segments, words, vocab=None, seed=0):
+    """ Generate a synthetic corpus
+
+    :param segments        source segments (see read_tarball())
+    :param words           number of words to generate
+    :param vocab           number of distinct forms, None for all
+    :param seed            random seed
+
+    :type segments         list
+    :type words            int
+    :type vocab            int or None
+    :type seed             int
+
+    Returns a list of segments. """
+
+    rng = random.Random(seed)
+
+    """ Most frequent analysis of each form """
+    analyses = Counter(tuple(word[1:]) for segment in segments
+                       for word in segment)
+    forms = Counter()
+    rows = {}
+    for row, freq in analyses.most_common():
+        form = row[0]
+        forms[form] += freq
+        rows.setdefault(form, row)
+
+    types = [form for form, _ in forms.most_common(vocab)]
+    weights = [forms[form] for form in types]
+    lengths = [len(segment) for segment in segments]
+
+    corpus = []
+    total = 0
+    while total < words:
+        length = min(rng.choice(lengths), words - total)
+        sample = rng.choices(types, weights=weights, k=length)
+        corpus.append([[str(i), *rows[form]]
+                       for i, form in enumerate(sample, start=1)])
+        total += length
+    return corpus
+
+
+def write_corpus(corpus, filename):
+    """ Write synthetic corpus as CoNLL-U """
+    with open(filename, 'w', encoding='utf-8') as f:
+        for segment in corpus:
+            for word in segment:
+                f.write('\t'.join(word) + '\n')
+            f.write('\n')
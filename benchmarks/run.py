@@ -0,0 +1,200 @@
+import os
+import sys
+import json
+import atexit
+import time
+import shutil
+import resource
+import tempfile
+import contextlib
+import multiprocessing
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+
+""" ===========================================================
+Benchmarks for the BabyLemmatizer lemmatization pipeline
+
+Runs Lemmatizer.run_model() on synthetic corpora with the stub
+translator backend (see stub.py), so that it needs no OpenNMT or
+GPU, and reports the wall time of its profiler spans, tokens/s
+and peak RSS as JSON. Run from the repository root:
+
+   python -m benchmarks.run --words=10000,100000 --vocab=2000
+
+Each corpus is lemmatized in a fresh process to get comparable
+peak RSS figures. Pipeline messages go to benchmark.log and the
+profiler traces to profile_<words>.jsonl in the work directory
+(see --keep).
+
+=========================================================== """
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import model_api
+import profiler
+import train_pipeline
+import lemmatizer_pipeline as lp
+from preferences import Paths
+from benchmarks import corpus
+
+""" Registers the stub backend into model_api.BACKENDS """
+from benchmarks import stub  # noqa: F401
+
+DEFAULT_TARBALL = os.path.join('conllu', 'lbtest1.tar.gz')
+
+
+def peak_rss():
+    """ Peak resident set size of this process in MB. VmHWM is
+    used on Linux, as ru_maxrss survives exec() and would include
+    the peak of the parent process. """
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss / 1024 ** 2
+    return rss / 1024
+
+
+def build_model(tarball, workdir):
+    """ Build a benchmark model (training data and post-processing
+    lexicons, no neural nets) from the tarball; returns its name """
+    name = os.path.basename(tarball).split('.')[0]
+    Paths.conllu = os.path.join(workdir, 'conllu')
+    Paths.models = os.path.join(workdir, 'models')
+    os.makedirs(Paths.conllu, exist_ok=True)
+    os.makedirs(Paths.models, exist_ok=True)
+    corpus.extract(tarball, Paths.conllu)
+
+    """ Build log is written into the working directory """
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        train_pipeline.build_train_data(name)
+    finally:
+        os.chdir(cwd)
+    return name
+
+
+def span_times(events):
+    """ Total wall time and number of calls of each profiler span,
+    slowest first. Spans are nested, e.g. pipeline.run_model
+    contains all the others. """
+    spans = {}
+    for event in events:
+        time_, calls = spans.get(event['name'], (0.0, 0))
+        spans[event['name']] = (time_ + event['duration'], calls + 1)
+    return {name: {'time': round(time_, 4), 'calls': calls}
+            for name, (time_, calls) in sorted(
+                    spans.items(), key=lambda item: -item[1][0])}
+
+
+def run_case(filename, workdir, model_name, words, columnar, workers):
+    """ Benchmark Lemmatizer.run_model() on one corpus with the
+    profiler enabled; run in a separate process """
+    Paths.conllu = os.path.join(workdir, 'conllu')
+    Paths.models = os.path.join(workdir, 'models')
+    engine = model_api.TranslatorEngine(
+        cpu=True, cache=False, workers=workers, backend='stub')
+    with open(os.path.join(workdir, 'benchmark.log'), 'a',
+              encoding='utf-8') as log, contextlib.redirect_stdout(log):
+        profiler.enable(os.path.join(workdir, f'profile_{words}.jsonl'))
+        rss_before = peak_rss()
+        start = time.perf_counter()
+        lemmatizer = lp.Lemmatizer(filename, columnar=columnar)
+        lemmatizer.run_model(model_name, True, engine)
+        total = time.perf_counter() - start
+        engine.unload()
+        profiler.write()
+        """ Do not write the trace again when the process exits """
+        atexit.unregister(profiler.write)
+
+    return {'words': words,
+            'columnar': columnar,
+            'workers': workers,
+            'spans': span_times(profiler.events),
+            'total': round(total, 4),
+            'tokens_per_s': round(words / total, 1),
+            'peak_rss_mb': round(peak_rss(), 1),
+            'baseline_rss_mb': round(rss_before, 1)}
+
+
+def run_benchmarks(tarball=DEFAULT_TARBALL, words=(10000,), vocab=None,
+                   seed=0, columnar=False, workers=1, keep=False):
+    """ Run benchmarks and return results as a dictionary
+
+    :param tarball         source data set
+    :param words           corpus sizes in words
+    :param vocab           number of distinct forms, None for all
+    :param seed            random seed for corpus generation
+    :param columnar        use columnar CoNLL-U+ storage
+    :param workers         number of stub translator processes
+    :param keep            keep work directory
+
+    :type tarball          str / path
+    :type words            iterable of int
+    :type vocab            int or None
+    :type seed             int
+    :type columnar         bool
+    :type workers          int
+    :type keep             bool """
+
+    workdir = tempfile.mkdtemp(prefix='babybench_')
+    results = {'tarball': tarball, 'seed': seed, 'vocab': vocab, 'runs': []}
+    try:
+        with open(os.path.join(workdir, 'benchmark.log'), 'w',
+                  encoding='utf-8') as log, contextlib.redirect_stdout(log):
+            start = time.perf_counter()
+            model_name = build_model(tarball, workdir)
+            results['build'] = round(time.perf_counter() - start, 4)
+        results['model'] = model_name
+
+        segments = corpus.read_tarball(tarball)
+        filenames = []
+        for size in words:
+            filename = os.path.join(workdir, f'bench_{size}.conllu')
+            corpus.write_corpus(
+                corpus.make_corpus(segments, size, vocab, seed), filename)
+            filenames.append(filename)
+        del segments
+
+        context = multiprocessing.get_context('spawn')
+        for size, filename in zip(words, filenames):
+            with ProcessPoolExecutor(1, mp_context=context) as executor:
+                run = executor.submit(
+                    run_case, filename, workdir, model_name, size,
+                    columnar, workers).result()
+            results['runs'].append(run)
+    finally:
+        if keep:
+            results['workdir'] = workdir
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+if __name__ == "__main__":
+    ap = ArgumentParser()
+    ap.add_argument('--tarball', type=str, default=DEFAULT_TARBALL)
+    ap.add_argument('--words', type=str, default='10000,100000')
+    ap.add_argument('--vocab', type=int)
+    ap.add_argument('--seed', type=int, default=0)
+    ap.add_argument('--columnar', action='store_true')
+    ap.add_argument('--workers', type=int, default=1)
+    ap.add_argument('--keep', action='store_true')
+    ap.add_argument('--output', type=str)
+    args = ap.parse_args()
+
+    results = run_benchmarks(
+        args.tarball, [int(x) for x in args.words.split(',')],
+        args.vocab, args.seed, args.columnar, args.workers, args.keep)
+
+    report = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(report + '\n')
+    print(report)
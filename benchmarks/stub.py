@@ -0,0 +1,31 @@
+import os
+import model_api
+
+""" ===========================================================
+Stub inference backend for BabyLemmatizer benchmarks
+
+Registered into model_api.BACKENDS as `stub` when this module is
+imported, so that it is available to the benchmarks only and not
+to the main command line.
+
+=========================================================== """
+
+
+class StubBackend(model_api.Backend):
+
+    """ Deterministic stand-in for the neural nets that needs no
+    OpenNMT or model checkpoints: the tagger predicts N for every
+    word and the lemmatizer copies the characters of the form.
+    Used for benchmarking the pure-Python parts of the pipeline. """
+
+    name = 'stub'
+
+    def translate(self, lines, model_name, threads=None):
+        if os.path.basename(os.path.dirname(model_name)) == 'tagger':
+            return ['N' for line in lines]
+        return [' '.join(char for char in line.split(' ')
+                         if not (char.startswith('P') and '=' in char))
+                for line in lines]
+
+
+model_api.BACKENDS[StubBackend.name] = StubBackend
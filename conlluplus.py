@@ -2,9 +2,15 @@ import time
 import re
 import os
 import sys
+import io
+import copy
+import threading
+from array import array
+from operator import itemgetter
 from collections import defaultdict
 from preferences import __version__
 import preprocessing as PP
+import profiler
 import cuneiformtools.tests as tests
 
 """ ============================================================
@@ -71,6 +77,12 @@ ID, FORM, LEMMA, UPOS, XPOS, FEATS,\
 
 LAST_FIELD = max(FIELDS.values())
 
+# Fields that are not interned by ColumnarConlluPlus; must be adjacent
+CONTEXT_FIELDS = (FORMCTX, XPOSCTX)
+
+# Missing value in the score column (NaN)
+NO_SCORE = float('nan')
+
 # CoNLL-U+ unit boundaries
 SOU = '<SOU>'
 EOU = '<EOU>'
@@ -110,6 +122,25 @@ def merge_backup(backup_file, pp_file):
                 else:
                     f_o.write(line + '\n')
     
+
+
+def write_info(f):
+    """ Write BabyLemmatizer header comments into a file """
+    f.write(f'# global.info = generated with BabyLemmatizer {__version__}; '\
+            'github.com/asahala/BabyLemmatizer\n')
+    f.write('# global.columns = ' + ' '.join(FIELDS) + '\n')
+
+
+def format_score(score):
+    """ Format float32 confidence score, e.g. 3.0 -> '3.0' """
+    return str(round(score, 6))
+
+
+def write_lemmalists(lemmadict, filename):
+    """ Write correction glossaries for each score """
+    for score, ldict in lemmadict.items():
+        ldict.write_file(score, filename)
+
                         
 class LemmaDict:
 
@@ -165,7 +196,9 @@ class ConlluPlus:
     def __init__(self, filename, validate=True):
         self.validate = validate
         self.filename = filename
-        self.data = []
+        self._init_storage()
+        """ Pending confidence scores, see set_scores() """
+        self.scores = None
         self.freqs = {'lemma': defaultdict(int),
                       'form': defaultdict(int),
                       'xpos': defaultdict(int)}
@@ -182,6 +215,50 @@ class ConlluPlus:
 
     def __len__(self):
         return self.word_count
+
+
+    def _init_storage(self):
+        """ Segments are stored as a list of (comments, words)
+        tuples, where each word is a list of field values """
+        self.data = []
+
+
+    def _append_segment(self, comments, lines):
+        self.data.append((comments, lines))
+
+
+    def _segments(self):
+        """ Yield (comments, words) for each segment """
+        for segment in self.data:
+            yield segment
+
+
+    def _iterate_segments(self, *fields):
+        """ Yield given fields of each segment separately """
+        for _, sentences in self._segments():
+            yield self._iterate_fields(sentences, *fields)
+
+
+    def _map_rows(self, update):
+        """ Run `update` on each word; words are modified in place """
+        for _, sents in self.data:
+            for sent in sents:
+                update(sent)
+
+
+    def count_words(self):
+        return sum(len(unit) for _, unit in self._segments())
+
+
+    def get_types(self, field):
+        """ Return the set of distinct values of a field """
+        index = FIELDS[field]
+        return {word[index] for _, sents in self._segments()
+                for word in sents}
+
+
+    def count_segments(self):
+        return len(self.data)
     
 
     def _is_valid(self, line, lineno):
@@ -223,16 +300,14 @@ class ConlluPlus:
             for word in unit:
                 yield word
         else:
+            """ itemgetter yields a value for one field and
+            a tuple for several """
+            getter = itemgetter(*(FIELDS[field] for field in fields))
             for word in unit:
-                result = []
-                for index in (FIELDS[field] for field in fields):
-                    result.append(word[index])
-                if len(result) == 1:
-                    yield result[0]
-                else:
-                    yield tuple(result)
+                yield getter(word)
 
 
+    @profiler.timed('conllu.read_corrections')
     def read_corrections(self, filename):
         """ Read corrected lemma files into CoNLL-U+ 
 
@@ -270,11 +345,12 @@ class ConlluPlus:
                 base[HEAD] = '0'
                 base[DEPREL] = 'root'
                 
-                self.data.append(([''], [base]))
+                self._append_segment([''], [base])
 
-        self.word_count = sum(len(unit) for _, unit in self.data)
+        self.word_count = self.count_words()
             
 
+    @profiler.timed('conllu.read_file')
     def read_file(self, filename):
         """ Reads and parses a CoNLL-U+ file. Forces
         additional fields for extra information 
@@ -286,55 +362,133 @@ class ConlluPlus:
         concatenate all the CoNLL-U+ files. """
 
         print(f'> Parsing {filename}')
+        for comments, lines in self._read_segments(filename):
+            self._append_segment(comments, lines)
+
+        if self.validate:
+            self._print_warnings()
+
+        self.word_count = self.count_words()
+        profiler.count('conllu.words_read', self.word_count)
+
+
+    def _read_segments(self, filename):
+        """ Parse a CoNLL-U+ file lazily segment by segment;
+        yields (comments, words) """
+        
         with open(filename, 'r', encoding='utf-8') as f:
-            lines = []
-            comments = []
-            for e, line in enumerate(f, start=1):
-                line = line.strip()
-                if line.startswith('#'):
-                    comments.append(line)
-                elif line:
-                    line = line.split('\t')
-                    if len(line) < LAST_FIELD:
-                        line.extend(['_'] * (LAST_FIELD - len(line) + 1))
-
-                    # DELETE LOCK
-                    line[-1] = '_'
-                    
-                    """ Fix empty elements """
-                    if '' in set(line):
-                        print(f'> ERROR: Empty field at line {e} -> '\
-                              'replaced with _')
-                        line = [x if x != '' else '_' for x in line]
-                        
-                    if self.validate:
-                        is_valid = self._is_valid(line, e)
+            yield from self._parse_lines(f)
+
 
-                    ## TODO: Add possibility to clean data automatically
+    def _parse_lines(self, f):
+        """ Parse CoNLL-U+ lines from any iterable of strings;
+        yields (comments, words) """
+        
+        lines = []
+        comments = []
+        for e, line in enumerate(f, start=1):
+            line = line.strip()
+            if line.startswith('#'):
+                comments.append(line)
+            elif line:
+                line = line.split('\t')
+                if len(line) < LAST_FIELD:
+                    line.extend(['_'] * (LAST_FIELD - len(line) + 1))
+
+                # DELETE LOCK
+                line[-1] = '_'
+                
+                """ Fix empty elements """
+                if '' in set(line):
+                    print(f'> ERROR: Empty field at line {e} -> '\
+                          'replaced with _')
+                    line = [x if x != '' else '_' for x in line]
                     
-                    lines.append(line)
+                if self.validate:
+                    is_valid = self._is_valid(line, e)
 
-                    self.freqs['lemma'][line[FIELDS['lemma']]] += 1
-                    self.freqs['form'][line[FIELDS['form']]] += 1
-                    self.freqs['xpos'][line[FIELDS['xpos']]] += 1
-                else:
-                    self.data.append((comments, lines))
-                    lines = []
-                    comments = []
+                ## TODO: Add possibility to clean data automatically
+                
+                lines.append(line)
 
-        if self.validate:
-            print('\n================================')
-            print('WARNINGS')
-            for k, v in self.warnings.items():
-                if v:
-                    print(k + ':\n================================\n')
-                    for warning in v:
-                        print(f'   {warning}')
-            print('\n')
+                self.freqs['lemma'][line[FIELDS['lemma']]] += 1
+                self.freqs['form'][line[FIELDS['form']]] += 1
+                self.freqs['xpos'][line[FIELDS['xpos']]] += 1
+            else:
+                yield comments, lines
+                lines = []
+                comments = []
+
+
+    @classmethod
+    def from_string(cls, text, validate=False):
+        """ Parse CoNLL-U+ data from a string, e.g. a
+        request body, without writing it to disk
+
+        :param text            CoNLL-U+ data
+        :param validate        Run validator to check data integrity
+
+        :type text             str
+        :type validate         bool """
 
-        self.word_count = sum(len(unit) for _, unit in self.data)
+        conllu = cls(None, validate=validate)
+        """ Make sure that the last segment is terminated """
+        lines = text.splitlines() + ['']
+        for comments, words in conllu._parse_lines(lines):
+            if words:
+                conllu._append_segment(comments, words)
+        conllu.word_count = conllu.count_words()
+        return conllu
+
+
+
+    def _print_warnings(self):
+        print('\n================================')
+        print('WARNINGS')
+        for k, v in self.warnings.items():
+            if v:
+                print(k + ':\n================================\n')
+                for warning in v:
+                    print(f'   {warning}')
+        print('\n')
+
+
+    @classmethod
+    def stream(cls, filename, size, validate=False):
+        """ Read a CoNLL-U+ file lazily in chunks of `size`
+        segments, so that files larger than memory can be
+        processed one chunk at a time.
+
+        :param filename        CoNLL-U path/filename
+        :param size            number of segments per chunk
+        :param validate        Run validator to check data integrity
+
+        :type filename         str / path
+        :type size             int
+        :type validate         bool """
+
+        print(f'> Streaming {filename}')
+        reader = cls(None, validate=validate)
+        chunk = None
+        for comments, lines in reader._read_segments(filename):
+            if chunk is None:
+                chunk = cls(None, validate=False)
+                chunk.filename = filename
+            chunk._append_segment(comments, lines)
+            if chunk.count_segments() == size:
+                chunk.word_count = chunk.count_words()
+                yield chunk
+                chunk = None
+
+        if chunk is not None:
+            chunk.word_count = chunk.count_words()
+            yield chunk
+
+        if validate:
+            reader._print_warnings()
 
             
+    @profiler.timed('conllu.write_file')
     def write_file(self, filename, add_info=False):
         """ Compiles and writes a CoNLL-U+ file
         :param filename        filename
@@ -343,18 +497,51 @@ class ConlluPlus:
         print(f'> Writing {filename}')
         with open(filename, 'w', encoding='utf-8') as f:
             if add_info:
-                f.write(f'# global.info = generated with BabyLemmatizer {__version__}; '\
-                    'github.com/asahala/BabyLemmatizer\n')
-                f.write('# global.columns = ' + ' '.join(FIELDS) + '\n')
-            for comments, sentence in self.data:
-                if comments:
-                    for comment in comments:
-                        f.write(comment + '\n')
-                for word in sentence:
-                    f.write('\t'.join(word) + '\n')
-                f.write('\n')
+                write_info(f)
+            self.write_segments(f)
+
 
+    def to_string(self, add_info=False):
+        """ Return the data as a CoNLL-U+ string """
+        f = io.StringIO()
+        if add_info:
+            write_info(f)
+        self.write_segments(f)
+        return f.getvalue()
 
+
+    def write_segments(self, f):
+        """ Write segments into an open file; used for writing
+        files incrementally chunk by chunk
+
+        :param f               file object
+        :type f                file """
+
+        self.flush_scores()
+        for comments, sentence in self._segments():
+            if comments:
+                for comment in comments:
+                    f.write(comment + '\n')
+            for word in sentence:
+                f.write('\t'.join(word) + '\n')
+            f.write('\n')
+
+
+    def chunks(self, size):
+        """ Yield consecutive chunks of `size` segments as
+        ConlluPlus objects. Chunks share the word lines with
+        this object, i.e. updating a chunk updates this object.
+
+        :param size            number of segments per chunk
+        :type size             int """
+
+        for i in range(0, len(self.data), size):
+            chunk = ConlluPlus(None, validate=False)
+            chunk.data = self.data[i:i+size]
+            chunk.word_count = chunk.count_words()
+            yield chunk
+
+            
     def get_word_freqs(self, field):
         """ Yields word frequencies """
         for k, v in sorted(self.freqs[field].items(),
@@ -366,12 +553,15 @@ class ConlluPlus:
         """ Yield given fields from data, e.g. xpos tags for each word
         :param *fields        Fields to be fetched
         :type *fields         *str """
-        
-        for _, sentences in self.data:
-            for sent in self._iterate_fields(sentences, *fields):
+
+        if not fields or 'score' in fields:
+            self.flush_scores()
+        for segment in self._iterate_segments(*fields):
+            for sent in segment:
                 yield sent
 
                     
+    @profiler.timed('conllu.get_contexts')
     def get_contexts(self, *fields, size=1):
         """ Fetch surrounding contexts of any fields
         :param *fields        Fields to be fetched
@@ -388,9 +578,9 @@ class ConlluPlus:
 
         """ Set window size and collect buffered tag sequence """
         window = (size * 2) + 1
-        for _, sentences in self.data:
+        for segment in self._iterate_segments(*fields):
             sequence = [start] * size
-            for unit in self._iterate_fields(sentences, *fields):
+            for unit in segment:
                 sequence.append(unit)
             sequence.extend([end] * size)
 
@@ -402,15 +592,87 @@ class ConlluPlus:
                 if seq[size] not in UNIT_MARKERS:
                     yield seq
 
+    def set_scores(self, scores):
+        """ Hold confidence scores of words as a float32 column
+        instead of the `score` field. Post-processing steps update
+        the column and the scores are formatted into the field
+        only when the data is written or read (flush_scores()).
+
+        :param scores          score of each word; NO_SCORE keeps
+                               the current value of the field
+        :type scores           iterable of float """
+
+        self.scores = array('f', scores)
+
+
+    @profiler.timed('conllu.flush_scores')
+    def flush_scores(self):
+        """ Write pending scores into the `score` field """
+        if self.scores is None:
+            return
+        scores = self.scores
+        self.scores = None
+        index = -1
+        
+        def update(sent):
+            nonlocal index
+            index += 1
+            score = scores[index]
+            if score == score:
+                sent[SCORE] = format_score(score)
+            return sent
+
+        self._map_rows(update)
+
+        
+    @profiler.timed('conllu.apply')
+    def apply(self, *updaters):
+        """ Run word updaters in a single pass over the data.
+        Updaters modify words in place; they are made by the
+        `*_updater()` methods, e.g.
+
+           x.apply(x.unlemmatize_updater(),
+                   x.force_value_updater('formctx', '_'))
+
+        does the same as calling unlemmatize() and force_value()
+        one after another, but traverses the data only once.
+
+        :param *updaters      word updaters
+        :type *updaters       *callable """
+
+        if len(updaters) == 1:
+            update, = updaters
+        else:
+            def update(sent):
+                for updater in updaters:
+                    updater(sent)
+                return sent
+
+        self._map_rows(update)
+
+        """ Print statistics collected during the pass """
+        for updater in updaters:
+            report = getattr(updater, 'report', None)
+            if report is not None:
+                report()
+
+
+    @profiler.timed('conllu.conditional_update_value')
     def conditional_update_value(self, mappings, fields):
+        self.apply(self.conditional_update_value_updater(mappings, fields))
+
+
+    def conditional_update_value_updater(self, mappings, fields):
 
-        self.e = 0
-        self.subs = 0
-        self.score = 0
+        e = 0
+        subs = 0
+        score = 0
+        scores = self.scores
 
         def update(sent):
+            nonlocal e, subs, score
             if sent[LOCK] != '_':
-                self.e += 1
+                e += 1
                 return sent
             
             key = tuple(sent[FIELDS[field]] for field in fields)
@@ -420,23 +682,35 @@ class ConlluPlus:
                     if isinstance(index, int):
                         if sent[index] != sub:
                             sent[index] = sub
-                            self.subs += 1
+                            subs += 1
                             
-                sent[FIELDS['score']] = str(float(
-                    sent[FIELDS['score']]) + substitutions['score'])
-                self.score += substitutions['score']
-            self.e += 1
+                """ e is the index of this word """
+                if scores is not None and scores[e] == scores[e]:
+                    scores[e] += substitutions['score']
+                else:
+                    sent[FIELDS['score']] = str(float(
+                        sent[FIELDS['score']]) + substitutions['score'])
+                score += substitutions['score']
+            e += 1
             return sent
-        
-        self.data = [(comments, [update(sent) for sent in sents]) for
-                     comments, sents in self.data]
 
-        print(f'  + Step score: {round(self.score / self.e, 2)} '\
-              f'Substitutions: {self.subs} '\
-              f'({round(100*self.subs / self.e, 2)}%)')
+        def report():
+            print(f'  + Step score: {round(score / e, 2)} '\
+                  f'Substitutions: {subs} '\
+                  f'({round(100*subs / e, 2)}%)')
+
+        update.report = report
+        return update
                 
         
+    @profiler.timed('conllu.update_value')
     def update_value(self, field, values):
+        self.apply(self.update_value_updater(field, values))
+
+
+    def update_value_updater(self, field, values):
+        if field == 'score':
+            self.flush_scores()
         print(f'> Updating field "{field}"')
         ## TODO: fix and add multi-field update
         def update(sent):
@@ -462,26 +736,31 @@ class ConlluPlus:
             #        sent[FIELDS[field]] = str(vals)
                 
             return sent
-        self.data = [(comments, [update(sent) for sent in sents])
-                     for comments, sents in self.data]
+        return update
 
 
+    @profiler.timed('conllu.force_value')
     def force_value(self, field, value):
+        self.apply(self.force_value_updater(field, value))
+
+
+    def force_value_updater(self, field, value):
+        if field == 'score':
+            self.flush_scores()
         print(f'> Removing field "{field}"')
         def update(sent):
             if sent[LOCK] != '_':
                 return sent
             sent[FIELDS[field]] = value
             return sent
-        
-        self.data = [(comments, [update(sent) for sent in sents])
-                     for comments, sents in self.data]
+        return update
 
 
     def remove_unannotated(self, sent):
         pass
     
 
+    @profiler.timed('conllu.normalize')
     def normalize(self, is_traindata=False):
         """ Run all normalizations for lemmatization and 
         transliteration. 
@@ -490,25 +769,31 @@ class ConlluPlus:
         :type is_trainingdata      bool 
 
         """
+        self.apply(self.normalize_updater(is_traindata))
+
+
+    def normalize_updater(self, is_traindata=False):
 
         ## TODO: laita mahdollisuus korjata virheitä
         ## esim. poistaa xlit jos ei lemmattu
         
         print(f'> Normalizing CoNLL-U')
+
+        """ Normalize each unique form and lemma only once """
+        forms = {form: PP.normalize_xlit(form)
+                 for form in self.get_types('form')}
+        lemmas = {lemma: PP.normalize_lemma(lemma)
+                  for lemma in self.get_types('lemma')}
+        
         def update(sent):
             if sent[LOCK] != '_':
                 return sent
-            xlit = sent[FORM]
-            lemma = sent[LEMMA]
-            xlit = PP.lowercase_determinatives(xlit)
-            xlit = PP.subscribe_indices(xlit)
-            xlit = PP.unify_h(xlit)
-            xlit = PP.remove_brackets(xlit)
-            lemma = PP.unify_h(lemma)
-            if not xlit:
-                xlit = '_'
-            if not lemma:
-                lemma = '_'
+            xlit = forms.get(sent[FORM])
+            if xlit is None:
+                xlit = PP.normalize_xlit(sent[FORM])
+            lemma = lemmas.get(sent[LEMMA])
+            if lemma is None:
+                lemma = PP.normalize_lemma(sent[LEMMA])
 
             #if is_traindata:
             #    sent = self.remove_unannotated
@@ -517,10 +802,10 @@ class ConlluPlus:
             sent[LEMMA] = lemma
             return sent
 
-        self.data = [(comments, [update(sent) for sent in sents])
-                     for comments, sents in self.data]
+        return update
 
 
+    @profiler.timed('conllu.override_form')
     def override_form(self, dictionary):
         """ Overides any annotation given to a form 
 
@@ -528,10 +813,19 @@ class ConlluPlus:
         :type dictionary       dict
 
         {form: {lemma: x, xpos: y}, ...} """
+        self.apply(self.override_form_updater(dictionary))
+
+
+    def override_form_updater(self, dictionary):
 
         ## TODO: Update also POS-contexts, now old context remains
+
+        index = -1
+        scores = self.scores
         
         def update(sent):
+            nonlocal index
+            index += 1
             if sent[LOCK] != '_':
                 return sent
             values = dictionary.get(sent[FORM], None)
@@ -540,69 +834,349 @@ class ConlluPlus:
             
             for k, v in values.items():
                 sent[FIELDS[k]] = v
-            sent[SCORE] = '4.0'
+            if scores is not None:
+                scores[index] = 4.0
+            else:
+                sent[SCORE] = '4.0'
             return sent
 
-        self.data = [(comments, [update(sent) for sent in sents])
-                     for comments, sents in self.data]
+        return update
            
         
+    @profiler.timed('conllu.make_lemmalists')
     def make_lemmalists(self):
         """ Extract all low-confidence lemmatizations from
         the file and write them into correction glossaries 
         aka lemmadicts. """
         
         lemmadict = defaultdict(LemmaDict)
+        self.collect_lemmalists(lemmadict)
+        write_lemmalists(lemmadict, self.filename)
+
+
+    def collect_lemmalists(self, lemmadict):
+        """ Add low-confidence lemmatizations into lemmadicts 
+
+        :param lemmadict       lemmadicts by score
+        :type lemmadict        defaultdict(LemmaDict) """
     
-        for comments, unit in self.data:
-            for form, lemma, xpos, score in self._iterate_fields(
-                    unit, 'form', 'lemma', 'xpos', 'score'):
+        self.flush_scores()
+        for segment in self._iterate_segments(
+                'form', 'lemma', 'xpos', 'score'):
+            for form, lemma, xpos, score in segment:
                 if score == '_':
                     continue
                 if float(score) <= 2.0:
                     lemmadict[score].add_entry(form, lemma, xpos)
 
-        for score, ldict in lemmadict.items():
-            ldict.write_file(score, self.filename)
-
 
+    @profiler.timed('conllu.unlemmatize')
     def unlemmatize(self, numbers=True):
         """ Remove lemmatization from numerals """
+        self.apply(self.unlemmatize_updater(numbers))
+
+
+    def unlemmatize_updater(self, numbers=True):
 
         if numbers:
             print('> Removing lemmatizations of numbers')
         
-        self.nums_removed = 0
-        self.lacunae_removed = 0
+        nums_removed = 0
+        lacunae_removed = 0
+        index = -1
+        scores = self.scores
+        
         def update(sent):
+            nonlocal nums_removed, lacunae_removed, index
+            index += 1
             if sent[LOCK] != '_':
                 return sent
 
             field_type = tests.is_numeral(sent[FORM])
             if field_type:
-                self.nums_removed += 1
+                nums_removed += 1
                 sent[LEMMA] = '_'
                 sent[XPOS] = 'n'
                 sent[MISC] = field_type
                 sent[SCORE] = '_'
+                if scores is not None:
+                    scores[index] = NO_SCORE
 
             lacuna_type = tests.is_lacuna(sent[FORM])
             if lacuna_type:
-                self.lacunae_removed += 1
+                lacunae_removed += 1
                 sent[LEMMA] = '_'
                 sent[XPOS] = 'u'
                 sent[MISC] = lacuna_type
                 sent[SCORE] = '_'
+                if scores is not None:
+                    scores[index] = NO_SCORE
                 
             return sent
-            
-        self.data = [(comments, [update(sent) for sent in sents])
-                     for comments, sents in self.data]
 
-        if self.nums_removed:
-            print(f'  + {self.nums_removed} numbers flattened')
-        if self.lacunae_removed:
-            print(f'  + {self.lacunae_removed} lacunae flattened')
+        def report():
+            if nums_removed:
+                print(f'  + {nums_removed} numbers flattened')
+            if lacunae_removed:
+                print(f'  + {lacunae_removed} lacunae flattened')
+
+        update.report = report
+        return update
+
+class ColumnarRow:
+
+    """ Word of ColumnarConlluPlus as seen by word updaters. Only
+    the fields the updater reads or writes by index are decoded
+    and encoded. One view is moved from word to word.
+
+    :param conllu          CoNLL-U+ object
+    :type conllu           ColumnarConlluPlus """
+
+    __slots__ = ('columns', 'strings', 'encoders', 'index')
+
+    def __init__(self, conllu):
+        self.columns = conllu.columns
+        self.strings = conllu.strings
+        self.encoders = conllu._encoders()
+        self.index = 0
+
+
+    def __getitem__(self, field):
+        if field in CONTEXT_FIELDS:
+            return self.columns[field][self.index]
+        return self.strings[self.columns[field][self.index]]
+
+
+    def __setitem__(self, field, value):
+        self.columns[field][self.index] = self.encoders[field](value)
+
+
+class ColumnarConlluPlus(ConlluPlus):
+
+    """ Memory-efficient variant of ConlluPlus for large files.
+
+    Instead of a Python list of strings per word, each field is
+    stored as an array of integer codes into a table of interned
+    strings. Context fields (formctx, xposctx) are nearly unique
+    for every word, so they are kept as lists of strings outside
+    the table and freed when they are reset to _. Segment
+    boundaries are stored as word offsets and comments only for
+    segments that have them. Words are decoded into lists on the
+    fly, so the methods of ConlluPlus work unchanged.
+
+    :param filename        CoNLL-U path/filename
+    :param validate        Run validator to check data integrity
+
+    :type filename         str / path
+    :type validate         bool """
+
+    def _init_storage(self):
+        self.strings = ['_']
+        self.codes = {'_': 0}
+        self.lock = threading.Lock()
+        self.columns = tuple([] if field in CONTEXT_FIELDS else array('I')
+                             for field in FIELDS.values())
+        """ Word offsets of segments; segment i spans words
+        offsets[i]...offsets[i+1] """
+        self.offsets = array('I', [0])
+        self.comments = {}
+        """ Words with more or fewer fields than FIELD_NAMES """
+        self.widths = {}
+        self.tails = {}
+        """ Range of segments visible through this object """
+        self.span = None
+
+
+    def _encode(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            """ Chunks share the string table and may be
+            updated from different threads """
+            with self.lock:
+                code = self.codes.get(value)
+                if code is None:
+                    code = len(self.strings)
+                    self.strings.append(value)
+                    self.codes[value] = code
+        return code
+
+
+    def _encoders(self):
+        """ Functions that encode values of each field """
+        return tuple(str if field in CONTEXT_FIELDS else self._encode
+                     for field in FIELDS.values())
+
+
+    def _decoder(self, field):
+        """ Function that decodes values of a field by word index """
+        column = self.columns[field]
+        if field in CONTEXT_FIELDS:
+            return column.__getitem__
+        strings = self.strings
+        return lambda index: strings[column[index]]
+
+
+    def _decode_row(self, index):
+        strings = self.strings
+        columns = self.columns
+        """ Context fields are adjacent, see CONTEXT_FIELDS """
+        row = [strings[column[index]] for column in columns[:FORMCTX]]
+        row += [columns[FORMCTX][index], columns[XPOSCTX][index]]
+        row += [strings[column[index]] for column in columns[SCORE:]]
+        width = self.widths.get(index)
+        if width is not None:
+            if width < len(row):
+                del row[width:]
+            else:
+                row.extend(self.tails[index])
+        return row
+
+
+    def _store_row(self, index, row):
+        for column, encode, value in zip(self.columns, self._encoders(), row):
+            column[index] = encode(value)
+        if len(row) > len(self.columns):
+            self.tails[index] = row[len(self.columns):]
+
+
+    def _append_segment(self, comments, lines):
+        segment = len(self.offsets) - 1
+        if comments:
+            self.comments[segment] = comments
+        width = len(self.columns)
+        encoders = self._encoders()
+        for line in lines:
+            index = len(self.columns[ID])
+            if len(line) != width:
+                self.widths[index] = len(line)
+                self.tails[index] = line[width:]
+            for column, encode, value in zip(self.columns, encoders, line):
+                column.append(encode(value))
+            for column in self.columns[len(line):]:
+                column.append('_' if isinstance(column, list) else 0)
+        self.offsets.append(len(self.columns[ID]))
+
+
+    def _segment_range(self):
+        if self.span is None:
+            return 0, len(self.offsets) - 1
+        return self.span
+
+
+    def _word_range(self):
+        first, last = self._segment_range()
+        return self.offsets[first], self.offsets[last]
+
+
+    def _segments(self, block=256):
+        """ Segments are decoded column by column in blocks of
+        `block` segments """
+        strings = self.strings
+        offsets = self.offsets
+        first_segment, last_segment = self._segment_range()
+        for start in range(first_segment, last_segment, block):
+            end = min(start + block, last_segment)
+            first, last = offsets[start], offsets[end]
+            fields = [column[first:last] if field in CONTEXT_FIELDS
+                      else list(map(strings.__getitem__, column[first:last]))
+                      for field, column in enumerate(self.columns)]
+            words = list(map(list, zip(*fields)))
+            if self.widths:
+                for index in range(first, last):
+                    if index in self.widths:
+                        words[index - first] = self._decode_row(index)
+            for segment in range(start, end):
+                yield self.comments.get(segment, []),\
+                    words[offsets[segment] - first:offsets[segment+1] - first]
+
+
+    def _iterate_segments(self, *fields):
+        if not fields:
+            for _, words in self._segments():
+                yield words
+            return
+
+        strings = self.strings
+        offsets = self.offsets
+        if len(fields) == 1:
+            field = FIELDS[fields[0]]
+            column = self.columns[field]
+            for segment in range(*self._segment_range()):
+                first, last = offsets[segment], offsets[segment+1]
+                if field in CONTEXT_FIELDS:
+                    yield column[first:last]
+                else:
+                    yield list(map(strings.__getitem__, column[first:last]))
+            return
+
+        decoders = [self._decoder(FIELDS[field]) for field in fields]
+        for segment in range(*self._segment_range()):
+            words = range(offsets[segment], offsets[segment+1])
+            yield [tuple(decode(index) for decode in decoders)
+                   for index in words]
+
+
+    def _map_rows(self, update):
+        """ Updaters get a ColumnarRow view of each word; words with
+        more or fewer fields than FIELD_NAMES are decoded into lists """
+        row = ColumnarRow(self)
+        widths = self.widths
+        for index in range(*self._word_range()):
+            if index in widths:
+                self._store_row(index, update(self._decode_row(index)))
+            else:
+                row.index = index
+                update(row)
+
+
+    def count_words(self):
+        first, last = self._word_range()
+        return last - first
+
+
+    def get_types(self, field):
+        column = self.columns[FIELDS[field]]
+        first, last = self._word_range()
+        if FIELDS[field] in CONTEXT_FIELDS:
+            return set(column[first:last])
+        return {self.strings[code] for code in set(column[first:last])}
+
+
+    def count_segments(self):
+        first, last = self._segment_range()
+        return last - first
+
+
+    @profiler.timed('conllu.normalize')
+    def normalize(self, is_traindata=False):
+        """ Normalize by remapping the codes of form and lemma
+        columns; each distinct value is normalized only once """
+
+        print('> Normalizing CoNLL-U')
+        first, last = self._word_range()
+        lock = self.columns[LOCK]
+        for field, normalize in ((FORM, PP.normalize_xlit),
+                                 (LEMMA, PP.normalize_lemma)):
+            column = self.columns[field]
+            codes = {code: self._encode(normalize(self.strings[code]))
+                     for code in set(column[first:last])}
+            for index in range(first, last):
+                """ Code 0 is _, i.e. the word is not locked """
+                if not lock[index]:
+                    column[index] = codes[column[index]]
+
+
+    def chunks(self, size):
+        """ Yield consecutive chunks of `size` segments. Chunks
+        are views to the columns of this object. """
+        
+        first, last = self._segment_range()
+        for i in range(first, last, size):
+            chunk = copy.copy(self)
+            chunk.span = (i, min(i + size, last))
+            chunk.word_count = chunk.count_words()
+            yield chunk
+
 
 
 if __name__ == "__main__":
@@ -267,16 +267,23 @@ def evaluate(predictions, gold_standard, model, model_path):
     return output, oov_rate
         
     
-def pipeline(*models, cpu=False, fast=False):
+def pipeline(*models, cpu=False, fast=False, workers=1, backend='onmt',
+             greedy_tagger=False):
     """ Run the whole evaluation pipeline for `models`
 
     :param models        model name
     :param cpu           run on CPU instead of GPU
     :param no_run        do not rerun tagger/lemmatizer
+    :param workers       number of CPU inference processes
+    :param backend       inference backend name
+    :param greedy_tagger greedy single-step tagging
        
     :type models         str
     :type cpu            bool
     :type no_run         bool
+    :type workers        int
+    :type backend        str
+    :type greedy_tagger  bool
 
     """
 
@@ -289,6 +296,11 @@ def pipeline(*models, cpu=False, fast=False):
     OOV_post = defaultdict(int)
     
     step = 'model.pt'
+
+    """ Translator shared by all evaluated models """
+    engine = model_api.TranslatorEngine(
+        cpu, workers=workers, backend=backend,
+        greedy_tagger=greedy_tagger)
     
     for model in models:
 
@@ -322,9 +334,9 @@ def pipeline(*models, cpu=False, fast=False):
             os.path.join(conllu_path, 'test.conllu'),
             validate=False)
 
-        this_data.force_value('lemma', '_')
-        this_data.force_value('xpos', '_')
-        this_data.force_value('upos', '_')
+        this_data.apply(this_data.force_value_updater('lemma', '_'),
+                        this_data.force_value_updater('xpos', '_'),
+                        this_data.force_value_updater('upos', '_'))
         
         if not fast:
             print(f'> Running model {model}')
@@ -333,7 +345,8 @@ def pipeline(*models, cpu=False, fast=False):
                 input_file = os.path.join(tagger_path, 'traindata', 'test.src'),
                 model_name = os.path.join(tagger_path, step),
                 output_file = os.path.join(eval_path, tagger_output),
-                cpu = cpu)
+                cpu = cpu,
+                engine = engine)
 
             #xpos_tags = model_api.read_results(os.path.join(eval_path, tagger_output))
             #this_data.update_value('xpos', xpos_tags)
@@ -352,7 +365,11 @@ def pipeline(*models, cpu=False, fast=False):
                 input_file = os.path.join(eval_path, lemmatizer_input),
                 model_name = os.path.join(lemmatizer_path, step),
                 output_file = os.path.join(eval_path, lemmatizer_output),
-                cpu = cpu)
+                cpu = cpu,
+                engine = engine)
+
+            """ Each fold has its own models """
+            engine.unload()
 
             """ Merge lemmatizer output with CoNLL-U+ """
             model_api.merge_tags(
@@ -422,8 +439,8 @@ def pipeline(*models, cpu=False, fast=False):
         P.fill_unambiguous(threshold = 0.7)
         P.disambiguate_by_pos_context(threshold = 0.7)
 
-        this_data.force_value('xposctx', '_')
-        this_data.force_value('formctx', '_')
+        this_data.apply(this_data.force_value_updater('xposctx', '_'),
+                        this_data.force_value_updater('formctx', '_'))
         this_data.write_file(
             filename = os.path.join(eval_path, 'test_pp.conllu'),
             add_info = True)
@@ -2,13 +2,18 @@
 # -*- coding: utf-8 -*-
 
 import os
+import glob
 import shutil
+import threading
+from queue import Queue, Full
+from collections import defaultdict
 #import conllutools as ct
 import conlluplus
 import preprocessing as pp
 import model_api
 from preferences import Paths, Tokenizer, Context
 import postprocess
+import profiler
 
 info = """===========================================================
 Lemmatizer pipeline for BabyLemmatizer 2
@@ -25,12 +30,63 @@ University of Helsinki
 def io(message):
     print(f'> {message}')
 
+""" Default number of segments per chunk for streaming """
+STREAM_CHUNK_SIZE = 1000
+
+""" Default number of words per combined batch in batch mode """
+BATCH_WORDS = 200000
+
+
+def load_model_settings(model_name):
+    """ Read tokenizer and context settings and tokenizer cache of
+    the model; returns paths to tagger and lemmatizer model.pt """
+    Tokenizer.read(model_name)
+    Context.read(model_name)
+    pp.load_token_cache(model_name)
+    
+    tagger_path = os.path.join(
+            Paths.models, model_name, 'tagger', 'model.pt')
+    lemmatizer_path = os.path.join(
+            Paths.models, model_name, 'lemmatizer', 'model.pt')
+    return tagger_path, lemmatizer_path
+
+
+@profiler.timed('pipeline.make_tagger_lines')
+def make_tagger_lines(conllu):
+    """ Normalize CoNLL-U+ and return tagger input lines """
+    conllu.normalize()
+    formctx = conllu.get_contexts('form', size=Context.tagger_context)
+    conllu.update_value('formctx', formctx)
+    return [pp.make_tagger_src(formctx, context=Context.tagger_context)
+            for formctx in conllu.get_contents('formctx')]
+
+@profiler.timed('pipeline.postprocess')
+def postprocess_conllu(conllu, P, ignore_numbers=True):
+    """ Post-process lemmatized CoNLL-U+ with a post-processor
+    that may be shared by many files or requests """
+    P.predictions = conllu
+    P.initialize_scores()
+    P.fill_unambiguous(threshold = 0.6)
+    P.disambiguate_by_pos_context(threshold = 0.6)
+    P.apply_override()
+    
+    """ Unlemmatize numbers and clean up temporary fields
+    in a single pass """
+    updaters = []
+    if ignore_numbers:
+        updaters.append(conllu.unlemmatize_updater(numbers=True))
+
+    updaters.append(conllu.force_value_updater('xposctx', '_'))
+    updaters.append(conllu.force_value_updater('formctx', '_'))
+    conllu.apply(*updaters)
+
 ## TODO: READ context settigns from MODEL!"!!!!
 #CONTEXT = Context.pos_context
 
 class Lemmatizer:
 
-    def __init__(self, input_file, fast=False, ignore_numbers=True):
+    def __init__(self, input_file, fast=False, ignore_numbers=True,
+                 columnar=False):
         path, file_ = os.path.split(input_file)
         f, e = file_.split('.')
 
@@ -46,6 +102,10 @@ class Lemmatizer:
 
         """ Parameters """
         self.ignore_numbers = ignore_numbers
+        if columnar:
+            self.conllu = conlluplus.ColumnarConlluPlus
+        else:
+            self.conllu = conlluplus.ConlluPlus
         
         fn = os.path.join(step_path, f)
         self.backup_file = os.path.join(path, f'backup_{f}.conllu')
@@ -55,14 +115,15 @@ class Lemmatizer:
         self.word_forms = fn + '.forms'
         self.tagger_input = fn + '.tag_src'
         self.tagger_output = fn + '.tag_pred'
+        self.tagger_topk = fn + '.tag_topk'
         self.lemmatizer_input = fn + '.lem_src'
         self.lemmatizer_output = fn + '.lem_pred'
         self.final_output = fn + '.final'
         self.line_count = 0
         self.segment_count = 0
         #self.preprocess_input(input_file)
-        """ Load and normalize source CoNLL-U+ file """
-        self.source_file = conlluplus.ConlluPlus(input_file, validate=False)
+        """ Source CoNLL-U+ file is loaded by run_model() """
+        self.source_file = None
                 
         
     def preprocess_source(self):
@@ -85,58 +146,106 @@ class Lemmatizer:
                f' words in {self.segment_count} segments.')
 
 
-    def update_model(self, model_name):
-        overrides = [os.path.join(self.input_path, f) for f\
-                     in os.listdir(self.input_path) if f.endswith('.tsv')]
-                
-        if overrides:
-            mod_o = os.path.join(
-                Paths.models, model_name, 'override', 'override.conllu')
-            override = conlluplus.ConlluPlus(mod_o, validate=False)
-            for o_file in overrides:
-                override.read_corrections(o_file)
-                override.normalize()
-                os.remove(o_file) # this is bad
-            override.write_file(mod_o)
+    def _tag_chunks(self, chunks, tagger_path, engine, handoff, stop):
+        """ Tagger stage of the streaming pipeline: preprocess and
+        tag chunks and hand them over to the lemmatizer stage.
+        Stops when `stop` is set by the lemmatizer stage. """
 
-            
-            
-    def run_model(self, model_name, cpu):
+        def put(item):
+            """ Wait for room in the handoff queue unless stopped """
+            while not stop.is_set():
+                try:
+                    handoff.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    pass
+            return False
 
-        """ Read Tokenizer Preferences """
-        Tokenizer.read(model_name)
-        Context.read(model_name)
-        
-        """ Update model override """
-        self.update_model(model_name)
+        try:
+            for chunk in chunks:
+                if stop.is_set():
+                    return
+                lines = make_tagger_lines(chunk)
+                self.line_count += len(lines)
+                self.segment_count += chunk.count_segments()
+                tags = engine.translate(lines, tagger_path, tagger=True)
+                if not put((chunk, tags)):
+                    return
+        except Exception as error:
+            put(error)
+        finally:
+            put(None)
+
+
+    def run_stages(self, chunks, tagger_path, lemmatizer_path, engine):
+        """ Run tagger and lemmatizer as a streaming pipeline over
+        chunks of segments, so that lemmatization of a chunk overlaps
+        with tagging of the next one. Yields the chunks once they
+        are lemmatized. Intermediate data is kept in memory and not
+        written into step files.
+
+        :param chunks           CoNLL-U+ chunks
+        :param tagger_path      path/filename to tagger model.pt
+        :param lemmatizer_path  path/filename to lemmatizer model.pt
+        :param engine           translator
+
+        :type chunks            iterable of conlluplus.ConlluPlus
+        :type tagger_path       str
+        :type lemmatizer_path   str
+        :type engine            model_api.TranslatorEngine """
+
+        """ Bounded handoff keeps at most two tagged chunks waiting """
+        handoff = Queue(maxsize=2)
+        stop = threading.Event()
+        tagger = threading.Thread(
+            target = self._tag_chunks,
+            args = (chunks, tagger_path, engine, handoff, stop),
+            daemon = True)
+        tagger.start()
+
+        """ Tagger stage is stopped also if the lemmatizer stage or
+        the consumer of the chunks fails """
+        try:
+            while True:
+                item = handoff.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                chunk, tags = item
+                lines = model_api.merge_predictions(
+                    tags, chunk, 'xpos', 'xposctx')
+                lemmas = engine.translate(lines, lemmatizer_path)
+                model_api.merge_predictions(lemmas, chunk, 'lemma', None)
+                yield chunk
+        finally:
+            stop.set()
+            tagger.join()
+
+        io(f'Input file size: {self.line_count}'\
+           f' words in {self.segment_count} segments.')
 
-        """ Load and normalize source CoNLL-U+ file """
-        self.source_file = conlluplus.ConlluPlus(
-            self.input_file, validate=False)
         
-        """ Backup for write-protected fields """
-        pp_file = self.input_file.replace('.conllu', '_pp.conllu')
-        if os.path.isfile(pp_file):
-            is_backup = True
-            shutil.copy(pp_file, self.backup_file)
-        else:
-            is_backup = False
-            
+    @profiler.timed('pipeline.run_steps')
+    def run_steps(self, tagger_path, lemmatizer_path, model_name, cpu, engine):
+        """ Run tagger and lemmatizer one after another over the
+        whole file, saving intermediate files to steps/ """
+        
         """ Preprocess data for lemmatization """
         self.preprocess_source()
-                
-        """ Set model paths """
-        tagger_path = os.path.join(
-                Paths.models, model_name, 'tagger', 'model.pt')
-        lemmatizer_path = os.path.join(
-                Paths.models, model_name, 'lemmatizer', 'model.pt')
 
         """ Run tagger on input """
         io(f'Tagging {self.tagger_input} with {model_name}')
+        if engine.greedy_tagger:
+            topk_file = self.tagger_topk
+        else:
+            topk_file = None
         model_api.run_tagger(self.tagger_input,
                              tagger_path,
                              self.tagger_output,
-                             cpu)
+                             cpu,
+                             engine,
+                             topk_file)
 
         """ Merge tags to make lemmatizer input """
         model_api.merge_tags(self.tagger_output,
@@ -150,7 +259,8 @@ class Lemmatizer:
         model_api.run_lemmatizer(self.lemmatizer_input,
                                  lemmatizer_path,
                                  self.lemmatizer_output,
-                                 cpu)
+                                 cpu,
+                                 engine)
 
         """ Merge lemmata to CoNLL-U+ """
         model_api.merge_tags(self.lemmatizer_output,
@@ -159,30 +269,168 @@ class Lemmatizer:
                              'lemma',
                              None)
 
-        ## TODO: fix path
 
-        self.source_file.write_file(
-                self.input_file.replace('.conllu', '_nn.conllu'))
+    @profiler.timed('pipeline.update_model')
+    def update_model(self, model_name):
+        overrides = [os.path.join(self.input_path, f) for f\
+                     in os.listdir(self.input_path) if f.endswith('.tsv')]
+                
+        if overrides:
+            mod_o = os.path.join(
+                Paths.models, model_name, 'override', 'override.conllu')
+            override = conlluplus.ConlluPlus(mod_o, validate=False)
+            for o_file in overrides:
+                override.read_corrections(o_file)
+                override.normalize()
+                os.remove(o_file) # this is bad
+            override.write_file(mod_o)
 
-        #""" Merge backup """
-        #pass
+            
+            
+    def postprocess(self, conllu, P):
+        """ Post-process lemmatized CoNLL-U+ 
+
+        :param conllu          lemmatized data
+        :param P               post-processor
+        
+        :type conllu           conlluplus.ConlluPlus
+        :type P                postprocess.Postprocessor """
+
+        postprocess_conllu(conllu, P, self.ignore_numbers)
+
+
+    @profiler.timed('pipeline.run_stream')
+    def run_stream(self, tagger_path, lemmatizer_path, model_name,
+                   engine, chunk_size):
+        """ Lemmatize the input file chunk by chunk without
+        loading it into memory. Each chunk is tagged, lemmatized,
+        post-processed and appended to the output files before
+        the next one is read from the disk. """
+
+        nn_file = self.input_file.replace('.conllu', '_nn.conllu')
+        pp_file = self.input_file.replace('.conllu', '_pp.conllu')
+        
+        P = postprocess.Postprocessor(
+            predictions = None,
+            model_name = model_name)
+        lemmadict = defaultdict(conlluplus.LemmaDict)
+
+        chunks = self.conllu.stream(self.input_file, chunk_size)
+        io(f'Writing {nn_file} and {pp_file}')
+        with open(nn_file, 'w', encoding='utf-8') as nn,\
+             open(pp_file, 'w', encoding='utf-8') as pp_:
+            conlluplus.write_info(pp_)
+            for chunk in self.run_stages(
+                    chunks, tagger_path, lemmatizer_path, engine):
+                chunk.write_segments(nn)
+                self.postprocess(chunk, P)
+                chunk.write_segments(pp_)
+                chunk.collect_lemmalists(lemmadict)
+
+        """ Write lemmalists """
+        conlluplus.write_lemmalists(lemmadict, self.input_file)
+
+        
+    @profiler.timed('pipeline.run_model')
+    def run_model(self, model_name, cpu, engine=None, chunk_size=None,
+                  stream=False):
+        """ Tag and lemmatize the input file 
+
+        :param model_name      model name
+        :param cpu             run on CPU instead of GPU
+        :param engine          translator shared between files
+        :param chunk_size      run tagger and lemmatizer as a streaming
+                               pipeline with this many segments per chunk
+        :param stream          read, process and write the input file
+                               chunk by chunk in constant memory
+
+        :type model_name       str
+        :type cpu              bool
+        :type engine           model_api.TranslatorEngine or None
+        :type chunk_size       int or None
+        :type stream           bool """
+
+        if engine is None:
+            engine = model_api.TranslatorEngine(cpu)
+
+        """ Read Tokenizer Preferences and set model paths """
+        tagger_path, lemmatizer_path = load_model_settings(model_name)
         
+        """ Update model override """
+        self.update_model(model_name)
+
+        """ Backup for write-protected fields """
+        self.backup()
+
+        """ Without resident models, translate.py would load both
+        models again for every chunk """
+        if not engine.backend.in_process:
+            if stream:
+                io(f'Warning: {engine.backend.name} reloads the models '\
+                   f'for every chunk, streaming will be slow')
+            elif chunk_size is not None:
+                io(f'Models cannot be kept in memory with '\
+                   f'{engine.backend.name}, processing the whole file')
+                chunk_size = None
+
+        if stream:
+            if chunk_size is None:
+                chunk_size = STREAM_CHUNK_SIZE
+            io(f'Streaming {self.input_file} through {model_name} '\
+               f'in chunks of {chunk_size} segments')
+            self.run_stream(tagger_path, lemmatizer_path, model_name,
+                            engine, chunk_size)
+            self.save_caches(model_name)
+            return
+
+        """ Load source CoNLL-U+ file """
+        self.source_file = self.conllu(
+            self.input_file, validate=False)
+
+        if chunk_size is not None:
+            io(f'Tagging and lemmatizing {self.input_file} with '\
+               f'{model_name} in chunks of {chunk_size} segments')
+            for _ in self.run_stages(self.source_file.chunks(chunk_size),
+                                     tagger_path, lemmatizer_path, engine):
+                pass
+        else:
+            self.run_steps(tagger_path, lemmatizer_path, model_name, cpu, engine)
+
         """ Initialize postprocessor """
         P = postprocess.Postprocessor(
             predictions = self.source_file,
             model_name = model_name)
+        self.write_outputs(P)
+        self.save_caches(model_name)
+
+
+    def backup(self):
+        """ Backup for write-protected fields """
+        pp_file = self.input_file.replace('.conllu', '_pp.conllu')
+        if os.path.isfile(pp_file):
+            self.is_backup = True
+            shutil.copy(pp_file, self.backup_file)
+        else:
+            self.is_backup = False
 
-        P.initialize_scores()
-        P.fill_unambiguous(threshold = 0.6)
-        P.disambiguate_by_pos_context(threshold = 0.6)
-        P.apply_override()
+
+    @profiler.timed('pipeline.write_outputs')
+    def write_outputs(self, P):
+        """ Write lemmatized source file, post-process it and
+        write the final output and lemmalists 
+
+        :param P               post-processor
+        :type P                postprocess.Postprocessor """
         
-        if self.ignore_numbers:
-            self.source_file.unlemmatize(numbers=True)
+        ## TODO: fix path
 
-        """ Temporary field cleanup """
-        self.source_file.force_value('xposctx', '_')
-        self.source_file.force_value('formctx', '_')
+        self.source_file.write_file(
+                self.input_file.replace('.conllu', '_nn.conllu'))
+
+        #""" Merge backup """
+        #pass
+        
+        self.postprocess(self.source_file, P)
         
         self.source_file.write_file(
             self.input_file.replace('.conllu', '_pp.conllu'), add_info=True)
@@ -194,12 +442,124 @@ class Lemmatizer:
             
         """ Write lemmalists """
         self.source_file.make_lemmalists()
+
+
+    def save_caches(self, model_name):
+        """ Save tokenizer cache for the next run """
+        pp.token_cache_info()
+        pp.save_token_cache(model_name)
         
 
     def override_cycle(self):
         """ Lemmatization cycle """
         filename, ext = os.path.splitext(self.filename)
-        
+
+
+def plan_files(input_dir=None, pattern=None):
+    """ List input files for batch lemmatization. Output files
+    of earlier runs (_nn, _pp, backup_) are skipped.
+
+    :param input_dir       directory of CoNLL-U+ files
+    :param pattern         glob pattern, relative to input_dir
+                           if it is given
+
+    :type input_dir        str / path or None
+    :type pattern          str or None """
+
+    if pattern is None:
+        pattern = '*.conllu'
+    if input_dir is not None:
+        pattern = os.path.join(input_dir, pattern)
+
+    filenames = []
+    for filename in sorted(glob.glob(pattern)):
+        name = os.path.basename(filename)
+        if not name.endswith('.conllu')\
+           or name.endswith(('_nn.conllu', '_pp.conllu'))\
+           or name.startswith('backup_'):
+            continue
+        filenames.append(filename)
+    return filenames
+
+
+@profiler.timed('pipeline.run_batch')
+def run_batch(filenames, model_name, cpu, engine=None, ignore_numbers=True,
+              columnar=False, batch_words=BATCH_WORDS):
+    """ Lemmatize many files with one model. Model settings, caches
+    and post-processor lexicons are loaded once, and the tagger and
+    lemmatizer inputs of files are concatenated into combined
+    batches of about `batch_words` words; results are split back
+    by file offsets and written into per-file _nn/_pp outputs.
+
+    :param filenames       CoNLL-U+ files
+    :param model_name      model name
+    :param cpu             run on CPU instead of GPU
+    :param engine          translator
+    :param ignore_numbers  unlemmatize numbers
+    :param columnar        use columnar CoNLL-U+ storage
+    :param batch_words     max number of words per batch
+
+    :type filenames        list of str
+    :type model_name       str
+    :type cpu              bool
+    :type engine           model_api.TranslatorEngine or None
+    :type ignore_numbers   bool
+    :type columnar         bool
+    :type batch_words      int """
+
+    if engine is None:
+        engine = model_api.TranslatorEngine(cpu)
+
+    tagger_path, lemmatizer_path = load_model_settings(model_name)
+    lemmatizers = [Lemmatizer(filename, ignore_numbers=ignore_numbers,
+                              columnar=columnar) for filename in filenames]
+    io(f'Lemmatizing {len(lemmatizers)} files with {model_name}')
+
+    """ Corrections are read once per input directory """
+    updated = set()
+    for lemmatizer in lemmatizers:
+        if lemmatizer.input_path not in updated:
+            lemmatizer.update_model(model_name)
+            updated.add(lemmatizer.input_path)
+            
+    P = postprocess.Postprocessor(
+        predictions = None,
+        model_name = model_name)
+
+    def run(batch, lines, offsets):
+        io(f'Tagging a batch of {len(batch)} files ({len(lines)} words)')
+        tags = engine.translate(lines, tagger_path, tagger=True)
+        lines = []
+        for lemmatizer, (start, end) in zip(batch, offsets):
+            lines.extend(model_api.merge_predictions(
+                tags[start:end], lemmatizer.source_file, 'xpos', 'xposctx'))
+
+        io(f'Lemmatizing a batch of {len(batch)} files')
+        lemmas = engine.translate(lines, lemmatizer_path)
+        for lemmatizer, (start, end) in zip(batch, offsets):
+            model_api.merge_predictions(
+                lemmas[start:end], lemmatizer.source_file, 'lemma', None)
+            lemmatizer.write_outputs(P)
+            """ Release the file before the next batch """
+            lemmatizer.source_file = None
+
+    batch, lines, offsets = [], [], []
+    for lemmatizer in lemmatizers:
+        lemmatizer.backup()
+        lemmatizer.source_file = lemmatizer.conllu(
+            lemmatizer.input_file, validate=False)
+        start = len(lines)
+        lines.extend(make_tagger_lines(lemmatizer.source_file))
+        batch.append(lemmatizer)
+        offsets.append((start, len(lines)))
+        if len(lines) >= batch_words:
+            run(batch, lines, offsets)
+            batch, lines, offsets = [], [], []
+    if batch:
+        run(batch, lines, offsets)
+
+    pp.token_cache_info()
+    pp.save_token_cache(model_name)
         
         
 if __name__ == "__main__":
@@ -0,0 +1,387 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import json
+import time
+import threading
+import urllib.request
+from queue import Queue, Empty
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import conlluplus
+import preprocessing as pp
+import model_api
+import postprocess
+import txt2conllu
+import lemmatizer_pipeline as lp
+from preferences import Server
+
+info = """===========================================================
+Lemmatization server for BabyLemmatizer 2
+
+Keeps the model, tokenizer caches and post-processor lexicons
+in memory and lemmatizes concurrent requests in shared batches.
+
+   POST /lemmatize                 CoNLL-U+ in, CoNLL-U+ out
+   POST /lemmatize?format=text     one segment per line, words
+                                   separated by spaces
+   GET  /status                    statistics as JSON
+
+Load test:
+
+   python lemmatizer_server.py --filename=file.conllu
+          --requests=200 --concurrency=8
+
+==========================================================="""
+
+
+def count_words(text, format='conllu'):
+    """ Number of words in a request body: word lines of CoNLL-U+
+    or space separated words of plain text; comment lines starting
+    with # are not counted """
+    lines = (line for line in text.splitlines()
+             if line.strip() and not line.startswith('#'))
+    if format == 'text':
+        return sum(len(line.split()) for line in lines)
+    return sum(1 for line in lines)
+
+
+class Request:
+
+    """ Lemmatization request waiting in the batch queue
+
+    :param text            request body
+    :param format          `conllu` or `text`
+
+    :type text             str
+    :type format           str """
+
+    def __init__(self, text, format='conllu'):
+        self.text = text
+        self.format = format
+        self.words = count_words(text, format)
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class LemmatizerServer:
+
+    """ Batching lemmatizer that keeps the model resident.
+    Requests are queued by the HTTP threads and processed by a
+    single worker thread: it waits at most `max_latency` seconds
+    after the first request for more requests (up to
+    `max_batch_words` words), runs them through the tagger and
+    the lemmatizer together and splits the results back.
+
+    :param model_name      model name
+    :param engine          translator
+    :param ignore_numbers  unlemmatize numbers
+    :param max_latency     batching deadline in seconds
+    :param max_batch_words max number of words per batch
+
+    :type model_name       str
+    :type engine           model_api.TranslatorEngine
+    :type ignore_numbers   bool
+    :type max_latency      float
+    :type max_batch_words  int """
+
+    def __init__(self, model_name, engine, ignore_numbers=True,
+                 max_latency=None, max_batch_words=None):
+        self.model_name = model_name
+        self.engine = engine
+        self.ignore_numbers = ignore_numbers
+        if max_latency is None:
+            max_latency = Server.max_latency
+        if max_batch_words is None:
+            max_batch_words = Server.max_batch_words
+        self.max_latency = max_latency
+        self.max_batch_words = max_batch_words
+
+        self.tagger_path, self.lemmatizer_path =\
+            lp.load_model_settings(model_name)
+
+        """ Lexicons and dictionaries are loaded on the first
+        batch and kept for the lifetime of the server """
+        self.postprocessor = postprocess.Postprocessor(
+            predictions = None,
+            model_name = model_name)
+
+        self.queue = Queue()
+        self.stats = {'requests': 0, 'batches': 0, 'words': 0}
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+
+    def submit(self, text, format='conllu'):
+        """ Lemmatize text and return CoNLL-U+; blocks until
+        the batch containing the request is finished """
+        request = Request(text, format)
+        if not request.words:
+            raise ValueError('No words to lemmatize')
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+
+    def _parse(self, request):
+        if request.format == 'text':
+            lines = (line for line in request.text.splitlines()
+                     if line.strip())
+            text = '\n'.join(txt2conllu.upl_to_lines(lines))
+        else:
+            text = request.text
+        return conlluplus.ConlluPlus.from_string(text)
+
+
+    def _collect(self):
+        """ Wait for a request and collect more until the deadline
+        or the word limit of the batch is reached """
+        request = self.queue.get()
+        if request is None:
+            return None
+        batch = [request]
+        words = request.words
+        deadline = time.monotonic() + self.max_latency
+        while words < self.max_batch_words:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self.queue.get(timeout=timeout)
+            except Empty:
+                break
+            if request is None:
+                self.queue.put(None)
+                break
+            batch.append(request)
+            words += request.words
+        return batch
+
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            try:
+                self.lemmatize(batch)
+            except Exception as e:
+                for request in batch:
+                    if not request.done.is_set():
+                        request.error = e
+                        request.done.set()
+
+
+    def _fail(self, request, error):
+        request.error = error
+        request.done.set()
+
+
+    def lemmatize(self, batch):
+        """ Run a batch of requests through the pipeline. Errors
+        in parsing or post-processing a request are reported to
+        that request only. """
+        requests, sources, lines, offsets = [], [], [], []
+        for request in batch:
+            try:
+                source = self._parse(request)
+                if not len(source):
+                    raise ValueError('No words to lemmatize')
+                tagger_lines = lp.make_tagger_lines(source)
+            except Exception as e:
+                self._fail(request, e)
+                continue
+            start = len(lines)
+            lines.extend(tagger_lines)
+            requests.append(request)
+            sources.append(source)
+            offsets.append((start, len(lines)))
+
+        if not requests:
+            return
+
+        tags = self.engine.translate(lines, self.tagger_path, tagger=True)
+        lines = []
+        for source, (start, end) in zip(sources, offsets):
+            lines.extend(model_api.merge_predictions(
+                tags[start:end], source, 'xpos', 'xposctx'))
+
+        lemmas = self.engine.translate(lines, self.lemmatizer_path)
+        for request, source, (start, end) in zip(requests, sources, offsets):
+            try:
+                model_api.merge_predictions(
+                    lemmas[start:end], source, 'lemma', None)
+                lp.postprocess_conllu(
+                    source, self.postprocessor, self.ignore_numbers)
+                request.result = source.to_string(add_info=True)
+            except Exception as e:
+                self._fail(request, e)
+                continue
+            request.done.set()
+
+        self.stats['requests'] += len(requests)
+        self.stats['batches'] += 1
+        self.stats['words'] += len(tags)
+
+
+    def close(self):
+        """ Stop the worker and save tokenizer caches """
+        self.queue.put(None)
+        self.worker.join()
+        pp.token_cache_info()
+        pp.save_token_cache(self.model_name)
+        self.engine.unload()
+
+
+def make_handler(server):
+    """ Create HTTP request handler class bound to `server` """
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def _reply(self, code, body, content_type):
+            body = body.encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if urlparse(self.path).path != '/status':
+                self._reply(404, 'Not found\n', 'text/plain')
+                return
+            self._reply(200, json.dumps(server.stats), 'application/json')
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path != '/lemmatize':
+                self._reply(404, 'Not found\n', 'text/plain')
+                return
+            format = parse_qs(url.query).get('format', ['conllu'])[0]
+            if format not in ('conllu', 'text'):
+                self._reply(400, f'Unknown format {format}\n', 'text/plain')
+                return
+            length = int(self.headers.get('Content-Length', 0))
+            text = self.rfile.read(length).decode('utf-8')
+            if not count_words(text, format):
+                self._reply(400, 'No words to lemmatize\n', 'text/plain')
+                return
+            try:
+                result = server.submit(text, format)
+            except ValueError as e:
+                self._reply(400, f'{e}\n', 'text/plain')
+                return
+            except Exception as e:
+                self._reply(500, f'{type(e).__name__}: {e}\n', 'text/plain')
+                return
+            self._reply(200, result, 'text/plain; charset=utf-8')
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(model_name, engine, ignore_numbers=True, host=None, port=None,
+          max_latency=None):
+    """ Run lemmatization server until interrupted
+
+    :param model_name      model name
+    :param engine          translator
+    :param ignore_numbers  unlemmatize numbers
+    :param host            host name
+    :param port            port
+    :param max_latency     batching deadline in seconds
+
+    :type model_name       str
+    :type engine           model_api.TranslatorEngine
+    :type ignore_numbers   bool
+    :type host             str
+    :type port             int
+    :type max_latency      float """
+
+    if host is None:
+        host = Server.host
+    if port is None:
+        port = Server.port
+
+    server = LemmatizerServer(model_name, engine,
+                              ignore_numbers=ignore_numbers,
+                              max_latency=max_latency)
+    httpd = ThreadingHTTPServer((host, port), make_handler(server))
+    print(f'> Serving {model_name} at http://{host}:{port}/lemmatize')
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        server.close()
+
+
+def percentile(values, p):
+    """ Nearest-rank percentile of sorted values """
+    index = max(0, min(len(values) - 1, round(p / 100 * len(values)) - 1))
+    return values[index]
+
+
+def load_test(url, filename, requests=100, concurrency=8, size=10):
+    """ Send segments of a CoNLL-U+ file to the server in requests
+    of `size` segments and report latency and throughput
+
+    :param url             server url
+    :param filename        CoNLL-U+ file
+    :param requests        number of requests
+    :param concurrency     number of parallel clients
+    :param size            number of segments per request
+
+    :type url              str
+    :type filename         str / path
+    :type requests         int
+    :type concurrency      int
+    :type size             int """
+
+    source = conlluplus.ConlluPlus(filename, validate=False)
+    bodies = [(chunk.to_string(), len(chunk)) for chunk in source.chunks(size)]
+    if not bodies:
+        print('> Nothing to send')
+        return
+
+    def send(i):
+        body, words = bodies[i % len(bodies)]
+        request = urllib.request.Request(
+            url, data=body.encode('utf-8'), method='POST')
+        start = time.perf_counter()
+        with urllib.request.urlopen(request) as response:
+            response.read()
+        return time.perf_counter() - start, words
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(send, range(requests)))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for latency, _ in results)
+    words = sum(words for _, words in results)
+    print(f'> Requests: {requests} ({concurrency} parallel)')
+    print(f'> Latency p50: {percentile(latencies, 50)*1000:.1f} ms')
+    print(f'> Latency p99: {percentile(latencies, 99)*1000:.1f} ms')
+    print(f'> Throughput: {words/elapsed:.1f} tokens/s')
+
+
+if __name__ == "__main__":
+    ap = ArgumentParser()
+    ap.add_argument('--filename', type=str, required=True)
+    ap.add_argument('--url', type=str,
+                    default=f'http://{Server.host}:{Server.port}/lemmatize')
+    ap.add_argument('--requests', type=int, default=100)
+    ap.add_argument('--concurrency', type=int, default=8)
+    ap.add_argument('--size', type=int, default=10)
+    args = ap.parse_args()
+    load_test(args.url, args.filename, args.requests,
+              args.concurrency, args.size)
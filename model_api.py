@@ -1,7 +1,17 @@
 import os
-from preferences import python_path, onmt_path, Context
+import io
+import math
+import time
+import subprocess
+import hashlib
+import sqlite3
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from preferences import python_path, onmt_path, Context, Tokenizer, Cache
 #import conllutools as ct
 import preprocessing as PP
+import profiler
 
 """ ===========================================================
 API for calling OpenNMT and performing intermediate steps for
@@ -16,26 +26,707 @@ University of Helsinki
 
 =========================================================== """
     
-def run_tagger(input_file, model_name, output_file, cpu=False):
-    gpu = ''
-    if not cpu:
-        gpu = '-gpu 0'
+def deduplicate(lines):
+    """ Collapse identical neural net inputs into unique keys
 
-    command = f"{python_path}python {onmt_path}translate.py -model"\
-        f" {model_name} -src {input_file} -output {output_file} {gpu} "\
-        "-min_length 1"
-    os.system(command)
+    :param lines           neural net input lines
+    :type lines            list of str
 
+    Returns unique lines in order of their first appearance and
+    the index of each input line in the unique list, i.e. 
+    [unique[i] for i in index] restores the original lines. """
 
-def run_lemmatizer(input_file, model_name, output_file, cpu=False):
-    gpu = ''
-    if not cpu:
-        gpu = '-gpu 0'
+    keys = {}
+    index = [keys.setdefault(line, len(keys)) for line in lines]
+    return list(keys), index
+
+
+def shard(lines, n):
+    """ Split lines into n contiguous shards of (nearly) equal
+    size; concatenating the shards restores the input """
+    size = int(math.ceil(len(lines) / n))
+    return [lines[i:i+size] for i in range(0, len(lines), size)]
+
+
+def limit_threads(threads):
+    """ Limit number of threads used by the current process """
+    for variable in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS'):
+        os.environ[variable] = str(threads)
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+
+
+class PredictionCache:
+
+    """ Persistent on-disk cache for neural net predictions of
+    a single model component (tagger or lemmatizer). Stored as
+    SQLite database in models/<name>/cache/<component>.sqlite.
+
+    The cache is keyed by the model fingerprint and the source
+    line. The fingerprint covers the content of model.pt and 
+    config.yaml and the tokenizer and context settings, and if it
+    changes (e.g. the model is retrained), the cache is emptied.
+    If the database cannot be written (e.g. the model directory is
+    read-only), cached predictions are still used but new ones are
+    not stored.
+
+    :param model_name      path/filename to model.pt
+    :param max_size        max number of cached predictions
+    :param backend         inference backend name
+    :param decoding        decoding mode, `beam` or `greedy`
+
+    :type model_name       str
+    :type max_size         int
+    :type backend          str
+    :type decoding         str """
+
+    """ Max number of SQLite query parameters """
+    chunk_size = 500
+
+    def __init__(self, model_name, max_size=None, backend='onmt',
+                 decoding='beam'):
+        component_path, _ = os.path.split(model_name)
+        model_path, component = os.path.split(component_path)
+        cache_path = os.path.join(model_path, 'cache')
+        os.makedirs(cache_path, exist_ok=True)
+
+        if max_size is None:
+            max_size = Cache.max_predictions
+        self.max_size = max_size
+        self.writable = True
+        self.fingerprint = self._fingerprint(
+            model_name, os.path.join(model_path, 'config.yaml'),
+            backend, decoding)
+        self.db = sqlite3.connect(
+            os.path.join(cache_path, f'{component}.sqlite'),
+            check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta '\
+                        '(key TEXT PRIMARY KEY, value TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS predictions '\
+                        '(source TEXT PRIMARY KEY, prediction TEXT, '\
+                        'used INTEGER)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS used_index '\
+                        'ON predictions (used)')
+        
+        """ Invalidate cache if model or its settings have changed """
+        row = self.db.execute(
+            "SELECT value FROM meta WHERE key = 'fingerprint'").fetchone()
+        if row is None or row[0] != self.fingerprint:
+            if row is not None:
+                print(f'> Model {model_name} has changed, clearing cache')
+            self.db.execute('DELETE FROM predictions')
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES "\
+                            "('fingerprint', ?)", (self.fingerprint,))
+        self.db.commit()
+
+
+    def _fingerprint(self, model_name, config_file, backend, decoding):
+        """ Hash model, config file, tokenization settings,
+        inference backend and decoding mode """
+        sha = hashlib.sha1()
+        for filename in (model_name, config_file):
+            if os.path.isfile(filename):
+                with open(filename, 'rb') as f:
+                    for block in iter(lambda: f.read(1 << 20), b''):
+                        sha.update(block)
+        sha.update(f'{Tokenizer.setting}|{Context.tagger_context}|'\
+                   f'{Context.lemmatizer_context}|{backend}|{decoding}'.encode('utf-8'))
+        return sha.hexdigest()
+
+
+    def get(self, lines):
+        """ Return {source line: prediction} for cached lines """
+        hits = {}
+        for i in range(0, len(lines), self.chunk_size):
+            chunk = lines[i:i+self.chunk_size]
+            query = 'SELECT source, prediction FROM predictions '\
+                    f'WHERE source IN ({",".join("?" * len(chunk))})'
+            hits.update(self.db.execute(query, chunk).fetchall())
+
+        """ Mark hits as recently used """
+        if self.writable:
+            now = int(time.time())
+            try:
+                self.db.executemany(
+                    'UPDATE predictions SET used = ? WHERE source = ?',
+                    ((now, line) for line in hits))
+                self.db.commit()
+            except sqlite3.Error as e:
+                self._read_only(e)
+        return hits
+
+
+    def put(self, lines, predictions):
+        """ Store predictions and evict least recently used
+        entries if the cache grows too large """
+        if not self.writable:
+            return
+        now = int(time.time())
+        try:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO predictions VALUES (?, ?, ?)',
+                ((line, pred, now) for line, pred
+                 in zip(lines, predictions)))
+
+            size = self.db.execute(
+                'SELECT COUNT(*) FROM predictions').fetchone()[0]
+            if size > self.max_size:
+                self.db.execute('DELETE FROM predictions WHERE source IN '\
+                                '(SELECT source FROM predictions '\
+                                'ORDER BY used LIMIT ?)',
+                                (size - self.max_size,))
+            self.db.commit()
+        except sqlite3.Error as e:
+            self._read_only(e)
+
+
+    def _read_only(self, error):
+        """ Stop writing into the cache after a failed write """
+        print(f'> Cannot write prediction cache ({error}), '\
+              'new predictions are not cached')
+        self.writable = False
+        self.db.rollback()
+
+
+    def close(self):
+        self.db.close()
+        
+
+def write_source(lines):
+    """ Write neural net input lines into a temporary file """
+    with tempfile.NamedTemporaryFile(
+            'w', encoding='utf-8', suffix='.src', delete=False) as f:
+        for line in lines:
+            f.write(line + '\n')
+        return f.name
+
+
+class Backend:
+
+    """ Base class for inference backends. Backends translate
+    lists of source lines with the given model.pt.
+
+    :param cpu             run on CPU instead of GPU
+    :type cpu              bool """
+
+    name = None
+
+    """ Backend keeps models in the memory of this process """
+    in_process = True
+    
+    def __init__(self, cpu=False):
+        self.cpu = cpu
+
+
+    def unload(self):
+        """ Release loaded models """
+        pass
+
+
+    def translate(self, lines, model_name, threads=None):
+        raise NotImplementedError
+
+    
+class TranslatePyBackend(Backend):
+
+    """ Calls OpenNMT translate.py for each input, using the
+    virtual environment defined in preferences.py """
+
+    name = 'translate.py'
+    in_process = False
+
+    def translate(self, lines, model_name, threads=None):
+        """ Translate source lines by calling translate.py """
+        gpu = ''
+        if not self.cpu:
+            gpu = '-gpu 0'
+
+        env = None
+        if threads is not None:
+            env = dict(os.environ, OMP_NUM_THREADS=str(threads),
+                       MKL_NUM_THREADS=str(threads))
+
+        src_file = write_source(lines)
+        output_file = src_file + '.pred'
+        command = f"{python_path}python {onmt_path}translate.py -model"\
+                  f" {model_name} -src {src_file} "\
+                  f"-output {output_file} {gpu} -min_length 1"
+        try:
+            subprocess.run(command, shell=True, env=env)
+            with open(output_file, 'r', encoding='utf-8') as f:
+                predictions = f.read().splitlines()
+        finally:
+            for filename in (src_file, output_file):
+                if os.path.isfile(filename):
+                    os.remove(filename)
+
+        return predictions
+    
+
+class OnmtBackend(Backend):
+
+    """ OpenNMT-py translator running in this process. Each model
+    checkpoint is loaded only once and kept in memory. """
+
+    name = 'onmt'
+    
+    def __init__(self, cpu=False):
+        import onmt # noqa: F401 raises ImportError if not installed
+        self.cpu = cpu
+        self.translators = {}
+
+
+    def load(self, model_name):
+        """ Load OpenNMT translator for the model checkpoint
+        unless it has already been loaded
+
+        :param model_name      path/filename to model.pt
+        :type model_name       str """
+        
+        if model_name in self.translators:
+            return self.translators[model_name]
+
+        from onmt.translate.translator import build_translator
+        from onmt.utils.parse import ArgumentParser
+        import onmt.opts as opts
+
+        print(f'> Loading {model_name}')
+        parser = ArgumentParser()
+        opts.translate_opts(parser)
+        args = ['-model', model_name, '-src', os.devnull, '-min_length', '1']
+        if not self.cpu:
+            args.extend(['-gpu', '0'])
+        opt = parser.parse_args(args)
+
+        ArgumentParser.validate_translate_opts(opt)
+        ArgumentParser._get_all_transform_translate(opt)
+        ArgumentParser._validate_transforms_opts(opt)
+        ArgumentParser.validate_translate_opts_dynamic(opt)
+
+        translator = build_translator(
+            opt, report_score=False, out_file=io.StringIO())
+        self.translators[model_name] = (opt, translator)
+        return opt, translator
+
+
+    def unload(self):
+        """ Release all loaded models """
+        self.translators = {}
+
+
+    def translate(self, lines, model_name, threads=None):
+        """ Translate source lines with a resident translator """
+        from onmt.inputters.dynamic_iterator import build_dynamic_dataset_iter
+        from onmt.inputters.inputter import IterOnDevice
+        from onmt.transforms import get_transforms_cls
+        from onmt.constants import CorpusTask
+
+        opt, translator = self.load(model_name)
+        opt.src = write_source(lines)
+
+        """ Collect output exactly as translate.py would write it """
+        translator.out_file = io.StringIO()
+        try:
+            transforms_cls = get_transforms_cls(opt._all_transform)
+            infer_iter = build_dynamic_dataset_iter(
+                opt, transforms_cls, translator.vocabs,
+                task=CorpusTask.INFER, copy=translator.copy_attn)
+            infer_iter = IterOnDevice(infer_iter, opt.gpu)
+            translator._translate(
+                infer_iter, transform=infer_iter.transform)
+        finally:
+            os.remove(opt.src)
+
+        return translator.out_file.getvalue().splitlines()
+
+
+    def tag(self, lines, model_name, threads=None, k=1, batch_size=64):
+        """ Greedy fast path for the POS-tagger. As tagger targets are
+        always a single XPOS tag, the encoder is run once and the tag
+        is taken from the first output distribution of the decoder
+        instead of doing beam search. Returns a list of top-k tags 
+        and their probabilities for each input line.
+
+        :param lines           tagger input lines
+        :param model_name      path/filename to tagger model.pt
+        :param k               number of best tags to return
+        :param batch_size      number of lines per batch
+
+        :type lines            list of str
+        :type model_name       str
+        :type k                int
+        :type batch_size       int """
+        
+        import torch
+        from onmt.constants import DefaultTokens
+
+        opt, translator = self.load(model_name)
+        model = translator.model
+        src_vocab = translator.vocabs['src']
+        tgt_vocab = translator.vocabs['tgt']
+        device = torch.device('cpu' if self.cpu else 'cuda')
+
+        src_pad = src_vocab.lookup_token(DefaultTokens.PAD)
+        bos = tgt_vocab.lookup_token(DefaultTokens.BOS)
+        
+        """ Tags can never be special symbols (cf. -min_length 1) """
+        banned = [tgt_vocab.lookup_token(token) for token in
+                  (DefaultTokens.EOS, DefaultTokens.BOS, DefaultTokens.PAD)]
+
+        """ Sort inputs by length to minimize padding """
+        tokens = [line.split() for line in lines]
+        order = sorted(range(len(lines)), key=lambda i: -len(tokens[i]))
+        results = [None] * len(lines)
+
+        with torch.no_grad():
+            for start in range(0, len(order), batch_size):
+                batch = order[start:start+batch_size]
+                lengths = [len(tokens[i]) for i in batch]
+                src = torch.full((len(batch), max(lengths), 1), src_pad,
+                                 dtype=torch.long, device=device)
+                for row, i in enumerate(batch):
+                    ids = [src_vocab.lookup_token(t) for t in tokens[i]]
+                    src[row, :len(ids), 0] = torch.tensor(ids, device=device)
+                src_len = torch.tensor(lengths, dtype=torch.long, device=device)
+
+                """ Encode and take a single decoder step from BOS """
+                enc_out, enc_final_hs, src_len = model.encoder(src, src_len)
+                model.decoder.init_state(src, enc_out, enc_final_hs)
+                tgt = torch.full((len(batch), 1, 1), bos,
+                                 dtype=torch.long, device=device)
+                dec_out, _ = model.decoder(
+                    tgt, enc_out, src_len=src_len, step=0)
+                
+                logits = model.generator(dec_out.squeeze(1)).float()
+                logits[:, banned] = -float('inf')
+                probs, indices = torch.softmax(logits, dim=-1).topk(k, dim=-1)
+
+                for row, i in enumerate(batch):
+                    results[i] = [(tgt_vocab.lookup_index(index), round(prob, 4))
+                                  for prob, index in zip(probs[row].tolist(),
+                                                         indices[row].tolist())]
+        return results
+
+
+class Int8Backend(OnmtBackend):
+
+    """ OpenNMT-py translator with int8 dynamic quantization of the
+    LSTM and linear layers for fast CPU inference. Models are
+    quantized when they are loaded. """
+
+    name = 'int8'
+    
+    def __init__(self, cpu=True):
+        if not cpu:
+            print('> Quantized models can be used only on CPU')
+        super().__init__(cpu=True)
+
+
+    def load(self, model_name):
+        if model_name in self.translators:
+            return self.translators[model_name]
+
+        import torch
+        opt, translator = super().load(model_name)
+        translator.model = torch.quantization.quantize_dynamic(
+            translator.model,
+            {torch.nn.LSTM, torch.nn.LSTMCell, torch.nn.Linear},
+            dtype=torch.qint8)
+        return opt, translator
+
+    
+""" Available inference backends """
+BACKENDS = {'onmt': OnmtBackend,
+            'int8': Int8Backend}
+
+
+def get_backend(name, cpu=False):
+    """ Initialize inference backend by name; falls back to
+    translate.py if the backend's libraries are not available """
+    try:
+        return BACKENDS[name](cpu=cpu)
+    except ImportError as error:
+        print(f'> Cannot use backend "{name}" ({error}), using '\
+              f'{onmt_path}translate.py instead')
+        return TranslatePyBackend(cpu=cpu)
+
+
+class TranslatorEngine:
+
+    """ Resident translator for BabyLemmatizer models.
+
+    Each model checkpoint is loaded only once and kept in memory,
+    so that tagging and lemmatizing a batch of files pays the
+    interpreter start-up and model loading cost only once.
+
+    Inference is done by a pluggable backend (see BACKENDS). If
+    its libraries cannot be imported into this interpreter (e.g.
+    OpenNMT is installed into the separate virtual environment
+    defined in preferences.py), translate.py is called for each
+    input instead.
+
+    Predictions are cached persistently per model (see
+    PredictionCache) unless caching is disabled.
+
+    On CPU, inputs can be decoded in parallel by `workers` processes
+    that each translate a contiguous shard of the input lines with
+    their own resident models and a limited number of threads.
+
+    Tags are predicted with beam search like lemmas. With
+    `greedy_tagger`, backends that support it predict the most
+    probable first token of the tagger output in a single step
+    instead, which is faster but may differ from beam search.
+
+    :param cpu             run on CPU instead of GPU
+    :param cache           use persistent prediction cache
+    :param workers         number of CPU inference processes
+    :param backend         inference backend name
+    :param greedy_tagger   greedy single-step tagging
+
+    :type cpu              bool
+    :type cache            bool
+    :type workers          int
+    :type backend          str
+    :type greedy_tagger    bool """
+
+    def __init__(self, cpu=False, cache=None, workers=1, backend='onmt',
+                 greedy_tagger=False):
+        self.cpu = cpu
+        self.caches = {}
+        if cache is None:
+            cache = Cache.predictions
+        self.use_cache = cache
+
+        if workers > 1 and not cpu:
+            print('> Multiple workers can be used only on CPU')
+            workers = 1
+        self.workers = workers
+        self.threads = max(1, (os.cpu_count() or 1) // workers)
+        self.pool = None
+        self.lock = threading.Lock()
+
+        self.backend_name = backend
+        self.backend = get_backend(backend, cpu)
+
+        if greedy_tagger and not self.supports_tag:
+            print(f'> Backend {backend} does not support greedy tagging')
+            greedy_tagger = False
+        self.greedy_tagger = greedy_tagger
+
+
+    def unload(self):
+        """ Release all loaded models, caches and workers """
+        self.backend.unload()
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+        for cache in self.caches.values():
+            if cache is not None:
+                cache.close()
+        self.caches = {}
+
+
+    def get_cache(self, model_name, tagger=False):
+        """ Open prediction cache for the model; returns None if
+        the cache cannot be opened, e.g. in a read-only location """
+        with self.lock:
+            if model_name not in self.caches:
+                if tagger and self.greedy_tagger:
+                    decoding = 'greedy'
+                else:
+                    decoding = 'beam'
+                try:
+                    cache = PredictionCache(
+                        model_name, backend=self.backend.name,
+                        decoding=decoding)
+                except (OSError, sqlite3.Error) as e:
+                    print(f'> Cannot open prediction cache for '\
+                          f'{model_name} ({e}), continuing without it')
+                    cache = None
+                self.caches[model_name] = cache
+            return self.caches[model_name]
+
+
+    @property
+    def supports_tag(self):
+        """ Backend supports single-step tag distributions """
+        return hasattr(self.backend, 'tag')
+
+    
+    def _translate_lines(self, lines, model_name, method='translate', **kwargs):
+        """ Decode list of source lines with the given backend
+        method, in parallel shards if multiple workers are used """
+        decode = getattr(self.backend, method)
+        if self.workers < 2 or len(lines) < self.workers:
+            return decode(lines, model_name, **kwargs)
+
+        shards = shard(lines, self.workers)
+        print(f'> Decoding {len(lines)} inputs in {len(shards)} shards '\
+              f'({self.threads} threads each)')
         
-    command = f"{python_path}python {onmt_path}translate.py -model"\
-              f" {model_name} -src {input_file} "\
-              f"-output {output_file} {gpu} -min_length 1"
-    os.system(command)
+        if self.backend.in_process:
+            with self.lock:
+                if self.pool is None:
+                    self.pool = ProcessPoolExecutor(
+                        max_workers = self.workers,
+                        initializer = _init_worker,
+                        initargs = (self.threads, self.backend_name,
+                                    type(self.backend)))
+            n = len(shards)
+            results = self.pool.map(
+                _translate_shard, shards, [model_name] * n,
+                [method] * n, [kwargs] * n)
+        else:
+            with ThreadPoolExecutor(max_workers=len(shards)) as pool:
+                results = list(pool.map(
+                    lambda lines: decode(
+                        lines, model_name, self.threads, **kwargs), shards))
+
+        return [prediction for predictions in results
+                for prediction in predictions]
+
+
+    @profiler.timed('model_api.decode')
+    def _decode(self, lines, model_name, tagger=False):
+        """ Decode unique lines; use greedy fast path for the
+        tagger if it is enabled """
+        if tagger and self.greedy_tagger:
+            return [tags[0][0] for tags in
+                    self._translate_lines(lines, model_name, 'tag', k=1)]
+        return self._translate_lines(lines, model_name)
+
+    
+    @profiler.timed('model_api.translate')
+    def translate(self, lines, model_name, tagger=False):
+        """ Translate source lines with the given model. Identical
+        lines are translated only once.
+
+        :param lines           neural net input lines
+        :param model_name      path/filename to model.pt
+        :param tagger          model is a POS-tagger
+
+        :type lines            iterable of str
+        :type model_name       str
+        :type tagger           bool
+
+        Returns a list of predictions in the same order as the
+        input lines, formatted as in translate.py output. """
+
+        lines = list(lines)
+        if not lines:
+            return []
+
+        unique, index = deduplicate(lines)
+        print(f'> Deduplicated {len(lines)} inputs into {len(unique)} '\
+              f'unique ({round(len(lines) / len(unique), 2)}x)')
+        profiler.count('model_api.inputs', len(lines))
+        profiler.count('model_api.unique_inputs', len(unique))
+
+        """ Send only cache misses to the neural net """
+        cache = None
+        if self.use_cache:
+            cache = self.get_cache(model_name, tagger)
+        if cache is not None:
+            cached = cache.get(unique)
+            misses = [line for line in unique if line not in cached]
+            print(f'> Found {len(cached)} cached predictions, '\
+                  f'{len(misses)} inputs to translate')
+        else:
+            cached = {}
+            misses = unique
+
+        profiler.count('model_api.decoded_inputs', len(misses))
+        if misses:
+            translated = self._decode(misses, model_name, tagger)
+            if cache is not None:
+                cache.put(misses, translated)
+            cached.update(zip(misses, translated))
+
+        predictions = [cached[line] for line in unique]
+        return [predictions[i] for i in index]
+
+
+    def tag(self, lines, model_name, k=5):
+        """ Return top-k tag distributions for tagger input lines
+        as lists of (tag, probability). Unless greedy tagging is
+        enabled, only the beam search tag is returned with
+        probability 1.0 """
+
+        lines = list(lines)
+        if not lines:
+            return []
+
+        if not self.greedy_tagger:
+            return [[(tag, 1.0)] for tag in
+                    self.translate(lines, model_name, tagger=True)]
+        
+        unique, index = deduplicate(lines)
+        distributions = self._translate_lines(unique, model_name, 'tag', k=k)
+        return [distributions[i] for i in index]
+
+
+    def translate_file(self, input_file, model_name, output_file, tagger=False):
+        """ Translate input file and write predictions into
+        output file line by line """
+        with open(input_file, 'r', encoding='utf-8') as f:
+            lines = f.read().splitlines()
+
+        predictions = self.translate(lines, model_name, tagger)
+        
+        with open(output_file, 'w', encoding='utf-8') as f:
+            for prediction in predictions:
+                f.write(prediction + '\n')
+
+
+""" Resident translator of a CPU inference worker process """
+_worker_engine = None
+
+def _init_worker(threads, backend, backend_class):
+    global _worker_engine
+    limit_threads(threads)
+
+    """ Backends registered outside this module (e.g. in benchmarks)
+    are not known to spawned worker processes """
+    BACKENDS.setdefault(backend, backend_class)
+    _worker_engine = TranslatorEngine(cpu=True, cache=False, backend=backend)
+
+
+def _translate_shard(lines, model_name, method, kwargs):
+    decode = getattr(_worker_engine.backend, method)
+    return decode(lines, model_name, **kwargs)
+
+    
+def run_tagger(input_file, model_name, output_file, cpu=False, engine=None,
+               topk_file=None, k=5):
+    """ Run POS-tagger on input file. If `topk_file` is given, 
+    the top-k tags and their probabilities are written into it
+    as TAG:PROB pairs separated by spaces """
+    if engine is None:
+        engine = TranslatorEngine(cpu)
+
+    if topk_file is None:
+        engine.translate_file(input_file, model_name, output_file, tagger=True)
+        return
+    
+    with open(input_file, 'r', encoding='utf-8') as f:
+        lines = f.read().splitlines()
+
+    distributions = engine.tag(lines, model_name, k)
+
+    with open(output_file, 'w', encoding='utf-8') as o_file,\
+         open(topk_file, 'w', encoding='utf-8') as k_file:
+        for tags in distributions:
+            o_file.write(tags[0][0] + '\n')
+            k_file.write(' '.join(f'{tag}:{prob}' for tag, prob in tags) + '\n')
+
+
+def run_lemmatizer(input_file, model_name, output_file, cpu=False, engine=None):
+    if engine is None:
+        engine = TranslatorEngine(cpu)
+    engine.translate_file(input_file, model_name, output_file)
 
 
 def read_results(filename):
@@ -46,6 +737,39 @@ def read_results(filename):
             yield line.replace(' ', '').rstrip()
 
 
+@profiler.timed('model_api.merge_predictions')
+def merge_predictions(predictions, conllu_object, field, fieldctx):
+    """ Merge neural net predictions with the CoNLL-U+ object and
+    generate input lines for the next step in pipeline 
+
+    :param predictions           Neural net predictions
+    :param conllu_object         File for storing the annotations
+    :param field                 Which field to populate with the output
+    :param fieldctx              Which context field to update
+
+    :type predictions            iterable of str
+    :type conllu_object          ConlluPlus obj
+    :type field                  str
+    :type fieldctx               str or None 
+
+    Returns list of lemmatizer input lines if `fieldctx` is given. """
+
+    annotations = (line.replace(' ', '').rstrip() for line in predictions)
+    conllu_object.update_value(field, annotations)
+
+    contexts = {'xpos': Context.lemmatizer_context,
+                'form': Context.tagger_context}
+
+    if fieldctx is None:
+        return []
+
+    ctx_annotations = conllu_object.get_contexts(field, size=contexts[field])
+    conllu_object.update_value(fieldctx, ctx_annotations)
+
+    return [PP.make_lem_src(form, xposctx) for form, xposctx
+            in conllu_object.get_contents('form', 'xposctx')]
+
+
 def merge_tags(neural_net_output, conllu_object, output_file, field, fieldctx):
     """ Merge neural net output with the CoNLL-U+ object and generate
     data for the next step in pipeline 
@@ -61,24 +785,14 @@ def merge_tags(neural_net_output, conllu_object, output_file, field, fieldctx):
     :type output_file            path/file as str or None
     :type field                  str
     :type fieldctx               str or None """
-
-    ## TODO: tee tää suoraan tagger/lemmatisaattorikutsun
-    ## yhteydessä, etenkin jos tästä tulee modulaarisempi
-    
-    annotations = read_results(neural_net_output)
-    conllu_object.update_value(field, annotations)
-
-    contexts = {'xpos': Context.lemmatizer_context,
-                'form': Context.tagger_context}
     
-    if fieldctx is not None:
-        ctx_annotations = conllu_object.get_contexts(field, size=contexts[field])
-        conllu_object.update_value(fieldctx, ctx_annotations)
+    lines = merge_predictions(
+        read_results(neural_net_output), conllu_object, field, fieldctx)
 
     if output_file is not None and fieldctx is not None:
         with open(output_file, 'w', encoding='utf-8') as o_file:
-            for form, xposctx in conllu_object.get_contents('form', 'xposctx'):
-                o_file.write(PP.make_lem_src(form, xposctx) + '\n')
+            for line in lines:
+                o_file.write(line + '\n')
 
             
 def ___merge_tags(tagged_file, lemma_input, output_file):
@@ -1,11 +1,245 @@
 import os
-import copy
-from collections import defaultdict
-from preferences import Paths
+import time
+import pickle
+from preferences import Paths, __version__
 import conlluplus as cplus
+import profiler
 
 #=============================================================================
 
+""" Lexicon file format version; increase on any change to
+the contents of Lexicon """
+LEXICON_VERSION = 2
+
+""" Key fields of the ambiguity tables used in post-processing """
+LEXICON_KEYS = ((cplus.FORM, cplus.XPOS), (cplus.FORM, cplus.XPOSCTX))
+
+
+def _signature(filename):
+    """ Identify file version by its size and modification time """
+    if not os.path.isfile(filename):
+        return None
+    stat = os.stat(filename)
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+class LemmaCounts:
+
+    """ Counts of lemmas given to words with the same key, e.g.
+    the same (form, xpos), for any number of key field tuples.
+    All keys are counted in a single pass over the data, and the
+    totals per key are kept alongside, so that lemmas above any
+    threshold can be queried without recounting.
+
+    :param keys            key field index tuples
+    :type keys             iterable of tuple(int) """
+
+    def __init__(self, keys):
+        self.keys = tuple(keys)
+        self.counts = {fields: {} for fields in self.keys}
+        self.totals = {fields: {} for fields in self.keys}
+
+
+    def add(self, words):
+        """ Count lemmas of words (CoNLL-U+ field lists) """
+        tables = [(fields, self.counts[fields], self.totals[fields])
+                  for fields in self.keys]
+        for word in words:
+            lemma = word[cplus.LEMMA]
+            for fields, counts, totals in tables:
+                key = tuple(word[index] for index in fields)
+                lemmata = counts.get(key)
+                if lemmata is None:
+                    counts[key] = lemmata = {}
+                lemmata[lemma] = lemmata.get(lemma, 0) + 1
+                totals[key] = totals.get(key, 0) + 1
+
+
+    def above(self, fields, threshold):
+        """ Yield (key, lemma) pairs where the lemma has been
+        given to at least `threshold` share of the words
+
+        :param fields          key field indices
+        :param threshold       minimum share of the lemma
+        :type fields           tuple(int)
+        :type threshold        float """
+        totals = self.totals[fields]
+        for key, lemmata in self.counts[fields].items():
+            total = totals[key]
+            for lemma, count in lemmata.items():
+                if count / total >= threshold:
+                    yield key, lemma
+
+
+class Lexicon:
+
+    """ Precompiled per-model lexicon for post-processing, stored
+    in models/<name>/lex/lexicon.pickle. Contains the in-vocabulary
+    forms, lemma counts for the ambiguity tables and the override
+    dictionary, so that the training data does not have to be
+    parsed for every lemmatized file.
+
+    The file starts with a header that records the format version
+    and the source files the lexicon was compiled from; lexicons
+    with an old version or outdated sources are not loaded.
+
+    :param model_name       model name
+    :type model_name        str """
+
+    def __init__(self, model_name):
+        self.model_name = model_name
+        path = os.path.join(Paths.models, model_name)
+        self.filename = os.path.join(path, 'lex', 'lexicon.pickle')
+        self.sources = {
+            'train': os.path.join(path, 'conllu', 'train.conllu'),
+            'types': os.path.join(path, 'lex', 'train-types.xlit')}
+        self.override_file = os.path.join(
+            path, 'override', 'override.conllu')
+        
+        self.invocab = set()
+        self.lemma_counts = LemmaCounts(LEXICON_KEYS)
+        self.override = {}
+        self.override_signature = None
+
+
+    def _header(self):
+        return {'format': 'babylemmatizer-lexicon',
+                'version': LEXICON_VERSION,
+                'babylemmatizer': __version__,
+                'sources': {name: _signature(filename) for name, filename
+                            in self.sources.items()}}
+
+
+    @profiler.timed('lexicon.compile')
+    def compile(self):
+        """ Build the lexicon from training data and override """
+        print(f'> Compiling lexicon for {self.model_name}')
+        with open(self.sources['types'], 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.rstrip()
+                self.invocab.add(line.split('\t')[0])
+
+        self.lemma_counts = self.count_lemmas(LEXICON_KEYS)
+        self.compile_override()
+
+
+    def count_lemmas(self, keys):
+        """ Count lemmas for given key field tuples in training data """
+        counts = LemmaCounts(keys)
+        train_data = cplus.ConlluPlus(self.sources['train'], validate=False)
+        counts.add(train_data.get_contents())
+        return counts
+
+
+    def get_lemma_counts(self, fields):
+        """ Return lemma counts for key fields; keys other than
+        LEXICON_KEYS are counted from the training data on demand """
+        if fields not in self.lemma_counts.keys:
+            self.lemma_counts = self.count_lemmas(
+                self.lemma_counts.keys + (fields,))
+        return self.lemma_counts
+
+
+    @profiler.timed('lexicon.compile_override')
+    def compile_override(self):
+        """ Build override dictionary {form: {lemma: x, xpos: y}} """
+        self.override = {}
+        self.override_signature = _signature(self.override_file)
+        if self.override_signature is None:
+            return
+        override = cplus.ConlluPlus(self.override_file, validate=False)
+        for form, lemma, xpos in override.get_contents('form', 'lemma', 'xpos'):
+            #form = form.strip('*') # remove stars
+            self.override[form] = {'lemma': lemma, 'xpos': xpos}
+
+
+    def get_override(self):
+        """ Return override dictionary; rebuild it if the override
+        file has been updated after compiling """
+        if _signature(self.override_file) != self.override_signature:
+            self.compile_override()
+        return self.override
+
+    
+    def save(self):
+        """ Save compiled lexicon; returns False if it cannot be
+        written, e.g. if the model directory is read-only, in
+        which case the lexicon is compiled again on the next run """
+        try:
+            with open(self.filename, 'wb') as f:
+                pickle.dump(self._header(), f,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+                pickle.dump((self.invocab,
+                             self.lemma_counts,
+                             self.override,
+                             self.override_signature),
+                            f, protocol=pickle.HIGHEST_PROTOCOL)
+        except OSError as e:
+            print(f'> Cannot save lexicon to {self.filename} ({e})')
+            return False
+        print(f'> Lexicon saved to {self.filename}')
+        return True
+
+
+    def is_current(self):
+        """ Check the header of the compiled lexicon without
+        loading the lexicon itself """
+        try:
+            with open(self.filename, 'rb') as f:
+                return pickle.load(f) == self._header()
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError,
+                TypeError):
+            return False
+
+
+    @profiler.timed('lexicon.load')
+    def load(self):
+        """ Load compiled lexicon; returns False if the file does
+        not exist or is outdated """
+        if not os.path.isfile(self.filename):
+            return False
+        try:
+            with open(self.filename, 'rb') as f:
+                header = pickle.load(f)
+                if header != self._header():
+                    return False
+                self.invocab, self.lemma_counts, self.override,\
+                    self.override_signature = pickle.load(f)
+        except (pickle.UnpicklingError, EOFError, ValueError, TypeError):
+            return False
+        return True
+
+
+def compile_lexicon(model_name):
+    """ Compile and save the post-processing lexicon of a model """
+    lexicon = Lexicon(model_name)
+    lexicon.compile()
+    lexicon.save()
+    return lexicon
+
+
+def update_lexicon(model_name):
+    """ Compile the post-processing lexicon of a model unless it is
+    up to date; returns True if the lexicon was compiled """
+    if Lexicon(model_name).is_current():
+        print(f'> Lexicon for {model_name} is up to date')
+        return False
+    compile_lexicon(model_name)
+    return True
+
+
+def load_lexicon(model_name):
+    """ Load the post-processing lexicon of a model; compile it if
+    it is missing or outdated """
+    t = time.time()
+    lexicon = Lexicon(model_name)
+    if lexicon.load():
+        print(f'> Loaded lexicon for {model_name} '\
+              f'in {round(time.time() - t, 3)} s')
+        return lexicon
+    return compile_lexicon(model_name)
+
+
 ## TODO: tee lista yleisimmistä virheistä
 
 ## TODO: kokeile sanavektoreita monitulkintaisimpien logogrammien
@@ -15,74 +249,87 @@ class Postprocessor:
     
     def __init__(self, predictions, model_name):
         self.model_name = model_name
-        self.train = os.path.join(
-            Paths.models, self.model_name,
-            'conllu', 'train.conllu')
-        self.override = os.path.join(
-            Paths.models, self.model_name,
-            'override', 'override.conllu')
 
         """ Container for the last post-processing step """
         if isinstance(predictions, str):
             predictions = cplus.ConlluPlus(predictions, validate=False)
 
         self.predictions = predictions
-        self.train_data = None
+        self.lexicon = None
+
+        """ Dictionaries are built once and reused if the
+        post-processor is run on several chunks of data """
+        self.lemmadicts = {}
+
+
+    def _get_lexicon(self):
+        if self.lexicon is None:
+            self.lexicon = load_lexicon(self.model_name)
+        return self.lexicon
 
         
+    @profiler.timed('postprocess.generate_lemmadict')
     def _generate_lemmadict(self, fields, threshold):
         """ Creates naive disambiguation dictionary based on
         FORM + an arbitrary tag mapped to a lemma """
         ## TODO: koita parantaa postägäystä, esim
         ## xlit + left context + right context --> lemma + POS
-        lems = defaultdict(dict)
-        if self.train_data is None:
-            self.train_data = cplus.ConlluPlus(self.train, validate=False)
-            
-        for data in self.train_data.get_contents():
-            key1 = data[fields[0]]
-            key2 = data[fields[1]]
-            lemma = data[2]            
-            lems[(key1, key2)].setdefault(lemma, 0)
-            lems[(key1, key2)][lemma] += 1
+        lems = self._get_lexicon().get_lemma_counts(fields)
                                                                             
         """ Collect lemmas that have been given to xlit + pos
         more often than the given threshold """
-        for xlit_pos, lemmata in lems.items():
+        for xlit_pos, lemma in lems.above(fields, threshold):
+            yield xlit_pos, lemma, 1.0 #score; now flat not
 
-            for lemma, count in lemmata.items():
-                score = count / sum(lemmata.values())
-                if score >= threshold:
-                    yield xlit_pos, lemma, 1.0 #score; now flat not
+                    
+    def _get_lemmadict(self, fields, threshold):
+        """ Reform dictionary in format 
+           {(input fields): 
+               {output_index: output, score: score}, ...} """
+        key = (fields, threshold)
+        if key not in self.lemmadicts:
+            self.lemmadicts[key] = {
+                xlit_pos : {cplus.LEMMA: lemma, 'score': score}
+                for xlit_pos, lemma, score in self._generate_lemmadict(
+                        fields=fields, threshold=threshold)}
+        return self.lemmadicts[key]
 
                     
+    @profiler.timed('postprocess.initialize_scores')
     def initialize_scores(self):
-        """ Initialize confidence scores """
-        invocab = set()
-        with open(os.path.join(Paths.models, self.model_name,
-                               'lex', 'train-types.xlit')) as f:
-            for line in f:
-                line = line.rstrip()
-                invocab.add(line.split('\t')[0])
+        """ Initialize confidence scores. Scores are computed once
+        per unique form and kept as a float32 column of the
+        predictions until they are written """
+        invocab = self._get_lexicon().invocab
 
-        def get_scores():
-            for sentence in self.predictions.get_contents():
-                form = sentence[cplus.FORM]
-                if form not in invocab:
-                    if form.lower() == form:
-                        score = 2.0
-                    elif form.upper() == form:
-                        score = 0.0
-                    else:
-                        score = 1.0
+        def score_form(form):
+            if form not in invocab:
+                if form.lower() == form:
+                    score = 2.0
+                elif form.upper() == form:
+                    score = 0.0
                 else:
-                    score = 3.0
+                    score = 1.0
+            else:
+                score = 3.0
+            return score
+
+        def get_scores():
+            form_scores = {}
+            for form, lock in self.predictions.get_contents('form', 'lock'):
+                if lock != '_':
+                    yield cplus.NO_SCORE
+                    continue
+                score = form_scores.get(form)
+                if score is None:
+                    score = form_scores[form] = score_form(form)
                 yield score
-                
-        self.predictions.update_value(
-            field = 'score', values = get_scores())
+
+        print('> Initializing confidence scores')
+        self.predictions.set_scores(get_scores())
         
 
+    @profiler.timed('postprocess.fill_unambiguous')
     def fill_unambiguous(self, threshold=0.9):
         """ First post-processing step: calculate close-to
         unambiguous word forms + pos tags from the training
@@ -94,18 +341,15 @@ class Postprocessor:
         print(f'> Post-processor ({self.model_name}): '\
               f'filling in unambiguous words (t ≥ {threshold})')
 
-        """ Reform dictionary in format 
-           {(input fields): 
-               {output_index: output, score: score}, ...} """
-        unambiguous = {xlit_pos : {cplus.LEMMA: lemma, 'score': score}
-                       for xlit_pos, lemma, score in self._generate_lemmadict(
-                               fields=(cplus.FORM, cplus.XPOS), threshold=threshold)}
+        unambiguous = self._get_lemmadict(
+            fields=(cplus.FORM, cplus.XPOS), threshold=threshold)
 
         """ Populate CoNLL-U with substitutions """
         self.predictions.conditional_update_value(
             unambiguous, fields = ('form', 'xpos'))
 
 
+    @profiler.timed('postprocess.disambiguate_by_pos_context')
     def disambiguate_by_pos_context(self, threshold=0.9):
         """ Disambiguate lemmata by their XPOS context; works
         just as fill_unambiguous() but uses XPOS context instead of
@@ -115,22 +359,17 @@ class Postprocessor:
         ## Ei kyllä toimi jos konteksti on vituillaan
         ## Markovin ketju? 
         
-        unambiguous = {xlit_pos : {cplus.LEMMA: lemma, 'score': score}
-                       for xlit_pos, lemma, score in self._generate_lemmadict(
-                               fields=(cplus.FORM, cplus.XPOSCTX), threshold=threshold)}  
+        unambiguous = self._get_lemmadict(
+            fields=(cplus.FORM, cplus.XPOSCTX), threshold=threshold)
 
         self.predictions.conditional_update_value(
             unambiguous, fields = ('form', 'xposctx'))
         
         
+    @profiler.timed('postprocess.apply_override')
     def apply_override(self):
-        """ Make override dictionary """
-        override = cplus.ConlluPlus(self.override, validate=False)
-
-        _dict = {}
-        for form, lemma, xpos in override.get_contents('form', 'lemma', 'xpos'):
-            #form = form.strip('*') # remove stars
-            _dict[form] = {'lemma': lemma, 'xpos': xpos}
+        """ Get override dictionary """
+        _dict = self._get_lexicon().get_override()
             
         # aa override ja ylikirjoita jokainen form overriden lemma + pos kombolla
         self.predictions.override_form(_dict)
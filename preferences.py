@@ -30,6 +30,50 @@ class Paths:
     models = 'models'
     override = 'override'
 
+
+class Cache:
+
+    """ Use persistent tagger and lemmatizer prediction cache that
+    is stored in models/<name>/cache/ """
+    predictions = True
+
+    """ Maximum number of cached predictions per model component """
+    max_predictions = 1000000
+
+    """ Save tokenizer caches with the model in models/<name>/cache/ """
+    tokens = True
+
+    """ Maximum number of memoized forms per tokenizer function;
+    None for unbounded """
+    max_tokens = 500000
+
+
+class Server:
+
+    """ Address of the lemmatization server (--serve) """
+    host = '127.0.0.1'
+    port = 8800
+
+    """ How long (seconds) a request may wait for other requests
+    to be batched with it """
+    max_latency = 0.05
+
+    """ Maximum number of words per batch """
+    max_batch_words = 20000
+
+
+class Training:
+
+    """ CPU slots (cores) shared by concurrent training jobs; None
+    for all cores. On GPU, the number of concurrent jobs. """
+    slots = None
+
+    """ Threads per training job on CPU """
+    threads = 4
+
+    """ How many times a failed build_vocab.py or train.py is retried """
+    retries = 1
+
     
 class Context:
     
@@ -1,11 +1,14 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import os
 import re
+import pickle
+import functools
 from cuneiformtools import util, norm, alphabet
 from cuneiformtools import tests
-from functools import lru_cache
-from preferences import Tokenizer
+from preferences import Tokenizer, Cache, Paths
+import profiler
 
 """ BabyLemmatizer 2 preprocessor 
 
@@ -15,21 +18,165 @@ asahala 2023
 
 LACUNA_METACHARS = frozenset(alphabet.LACUNA_META)
 
-@lru_cache(maxsize=256)
+""" Translation tables and patterns for normalization; the
+patterns detect forms that have something to normalize """
+REMOVE_LACUNA_META = str.maketrans('', '', alphabet.LACUNA_META)
+NUMERIC_INDEX = re.compile('[0-9]|x\\(')
+ACCENTED = re.compile(
+    '[' + alphabet.ACUTE + alphabet.GRAVE + ''.join(alphabet.DEACCENT) + ']')
+MISPLACED_INDEX = re.compile('(⌉|\\]|>+|\\||#)([₂₃])')
+
+""" Version of tokenizer output; increase on any change that
+affects the output of memoized functions to invalidate the
+tokenizer caches saved with models """
+TOKENIZER_VERSION = 1
+
+
+class Memo:
+
+    """ Memoization for tokenizer functions with a configurable
+    size (Cache.max_tokens, None = unbounded) and hit/miss counters.
+    Functions whose output depends on Tokenizer.setting are keyed
+    by (setting, input), so that the cache is safe to share between
+    models. The caches can be saved with a model and loaded on the
+    next run, see save_token_cache() and load_token_cache().
+
+    :param function          function of one string argument
+    :param setting_dependent output depends on Tokenizer.setting
+
+    :type function           callable
+    :type setting_dependent  bool """
+
+    registry = {}
+
+    def __init__(self, function, setting_dependent=False):
+        functools.update_wrapper(self, function)
+        self.function = function
+        self.setting_dependent = setting_dependent
+        self.cache = {}
+        self.hits = 0
+        self.misses = 0
+        Memo.registry[function.__name__] = self
+
+
+    def __call__(self, xlit):
+        if self.setting_dependent:
+            key = (Tokenizer.setting, xlit)
+        else:
+            key = xlit
+        try:
+            value = self.cache[key]
+            self.hits += 1
+            return value
+        except KeyError:
+            pass
+        
+        self.misses += 1
+        value = self.function(xlit)
+        if Cache.max_tokens is not None\
+           and len(self.cache) >= Cache.max_tokens:
+            """ Evict the oldest entry; may race with other threads """
+            try:
+                del self.cache[next(iter(self.cache))]
+            except (KeyError, RuntimeError, StopIteration):
+                pass
+        self.cache[key] = value
+        return value
+
+
+    def cache_clear(self):
+        self.cache = {}
+        self.hits = 0
+        self.misses = 0
+
+
+def memoize(setting_dependent=False):
+    """ Decorator for memoizing tokenizer functions """
+    def decorator(function):
+        return Memo(function, setting_dependent)
+    return decorator
+
+
+def token_cache_file(model_name):
+    return os.path.join(Paths.models, model_name, 'cache', 'tokens.pickle')
+
+
+def load_token_cache(model_name):
+    """ Warm up tokenizer caches from the ones saved with the model """
+    filename = token_cache_file(model_name)
+    if not Cache.tokens or not os.path.isfile(filename):
+        return
+    try:
+        with open(filename, 'rb') as f:
+            if pickle.load(f) != TOKENIZER_VERSION:
+                return
+            caches = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError,
+            TypeError):
+        return
+    for name, cache in caches.items():
+        memo = Memo.registry.get(name)
+        if memo is not None:
+            memo.cache.update(cache)
+    print(f'> Loaded tokenizer cache from {filename}')
+
+
+def save_token_cache(model_name):
+    """ Save tokenizer caches with the model """
+    if not Cache.tokens:
+        return
+    filename = token_cache_file(model_name)
+    try:
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, 'wb') as f:
+            pickle.dump(TOKENIZER_VERSION, f)
+            pickle.dump({name: memo.cache for name, memo
+                         in Memo.registry.items()},
+                        f, protocol=pickle.HIGHEST_PROTOCOL)
+    except OSError as e:
+        print(f'> Cannot save tokenizer cache to {filename} ({e})')
+
+
+def token_cache_info():
+    """ Print hit/miss counts of tokenizer caches """
+    for name, memo in Memo.registry.items():
+        if memo.hits or memo.misses:
+            print(f'> Tokenizer cache {name}: {memo.hits} hits, '\
+                  f'{memo.misses} misses, {len(memo.cache)} entries')
+
+
+def token_cache_counters():
+    """ Hit/miss counts of tokenizer caches for the profiler """
+    counters = {}
+    for name, memo in Memo.registry.items():
+        if memo.hits or memo.misses:
+            counters[f'tokenizer.{name}.hits'] = memo.hits
+            counters[f'tokenizer.{name}.misses'] = memo.misses
+    return counters
+
+
+profiler.register(token_cache_counters)
+
+
+@memoize()
 def lowercase_determinatives(xlit):
     return norm.unify_determinatives(xlit, lower=True)
 
 
-@lru_cache(maxsize=256)
+@memoize()
 def uppercase_determinatives(xlit):
     return norm.unify_determinatives(xlit, lower=False)
 
 
-@lru_cache(maxsize=512)
+@memoize()
 def subscribe_indices(xlit):
-    xlit = norm.digit_to_index(xlit)
-    xlit = norm.accent_to_index(xlit)
-    return xlit
+    """ Same as norm.digit_to_index() + norm.accent_to_index(),
+    but skips the character loops if there are no indices """
+    if NUMERIC_INDEX.search(xlit):
+        xlit = norm.digit_to_index(xlit)
+    if ACCENTED.search(xlit):
+        return norm.accent_to_index(xlit)
+    return MISPLACED_INDEX.sub(r'\2\1', xlit).rstrip()
 
 
 def unify_h(xlit):
@@ -37,10 +184,29 @@ def unify_h(xlit):
 
 
 def remove_brackets(xlit):
-    return ''.join(c for c in xlit if c not in LACUNA_METACHARS)
+    return xlit.translate(REMOVE_LACUNA_META)
+
+
+def normalize_xlit(xlit):
+    """ Normalize transliteration for lemmatization """
+    xlit = lowercase_determinatives(xlit)
+    xlit = subscribe_indices(xlit)
+    xlit = unify_h(xlit)
+    xlit = remove_brackets(xlit)
+    if not xlit:
+        xlit = '_'
+    return xlit
+
+
+def normalize_lemma(lemma):
+    """ Normalize lemma """
+    lemma = unify_h(lemma)
+    if not lemma:
+        lemma = '_'
+    return lemma
     
     
-@lru_cache(maxsize=256)
+@memoize(setting_dependent=True)
 def reformat(sign):
     """ Reformat cuneiform input """
     sign = sign.replace('*', '') # remove stars
@@ -55,12 +221,23 @@ def reformat(sign):
     else:
         return sign
 
-@lru_cache(maxsize=512)
+@memoize()
 def get_chars_lemma(lemma):
     return ' '.join(list(lemma))
 
 
-@lru_cache(maxsize=512)
+""" Precompiled patterns for get_chars() """
+DOT_RUN = re.compile(r'\.\.+')
+SIGN_DELIMITER = re.compile(r'(\{\+|[{}.:\- †])')
+COMPLEMENT = re.compile(r'(\{\+)(.+?)(\})')
+SPACES = re.compile(' +')
+
+""" Tokenizer output of each delimiter """
+DELIMITER_FORMAT = {'{': ' {', '}': '} ', '.': ' . ', ':': ' : ',
+                    '-': ' - ', ' ': '   ', '{+': ' {+ ', '†': ' {+ '}
+
+
+@memoize(setting_dependent=True)
 def get_chars(xlit):
 
     """ It seems that the best tokenization for Akkadian includes
@@ -69,9 +246,59 @@ def get_chars(xlit):
     - removal of indices for lowerase
     - preserving indices for uppercase
     - splitting logograms at .
+
+    Splits the transliteration into signs and delimiters with one
+    precompiled pattern. Gives the same output as get_chars_reference().
     
     """
     
+    if xlit == '_':
+        return xlit
+
+    """ If used for languages with alphabet """
+    if Tokenizer.setting == 2:
+        return ' '.join(list(xlit))
+
+    """ Signs in pipes may contain delimiters """
+    if '|' in xlit or '¤' in xlit:
+        return get_chars_reference(xlit)
+    
+    ## TODO MAKE THESE OPTIONAL
+    xlit = xlit.replace('*', '')
+    xlit = xlit.replace('{d}+', '{d}')
+    xlit = uppercase_determinatives(xlit)
+
+    """ Runs of dots are part of signs, e.g. x... """
+    xlit = DOT_RUN.sub('…', xlit)
+    tokens = SIGN_DELIMITER.split(xlit)
+    for i in range(0, len(tokens), 2):
+        tokens[i] = reformat(tokens[i].replace('…', '...'))
+    for i in range(1, len(tokens), 2):
+        tokens[i] = DELIMITER_FORMAT[tokens[i]]
+
+    xlit_ = ''.join(tokens).strip()
+    if '{+' in xlit_:
+        xlit_ = COMPLEMENT.sub(r'\1 \2 \3', xlit_)
+    return SPACES.sub(' ', xlit_)
+
+
+def get_chars_many(forms):
+    """ Tokenize a sequence of forms; returns a list """
+    tokenized = {}
+    result = []
+    for form in forms:
+        chars = tokenized.get(form)
+        if chars is None:
+            chars = tokenized[form] = get_chars(form)
+        result.append(chars)
+    return result
+
+
+def get_chars_reference(xlit):
+
+    """ Original implementation of get_chars(); used for signs
+    in pipes and for checking the tokenizer (check_tokenizer()) """
+    
     if xlit == '_':
         return xlit
 
@@ -99,7 +326,7 @@ def get_chars(xlit):
     return xlit_    
  
 
-@lru_cache(maxsize=512)
+@memoize()
 def get_signs(xlit):
     return ' '.join(
         (sign for sign in util.unzip_xlit(xlit)[0] if sign))
@@ -118,7 +345,7 @@ def get_signs(xlit):
 #    return f'{token} {context}\n'
 
 
-@lru_cache(maxsize=1024)
+@memoize(setting_dependent=True)
 def clean_traindata(xlit):
     xlit = remove_brackets(xlit)
     xlit = uppercase_determinatives(xlit)
@@ -129,9 +356,10 @@ def clean_traindata(xlit):
 
 def make_tagger_src(formctx, context):
     """ Format FORM context for training data """
-    return ' | '.join(f'<< {get_chars(xlit)} >>'
-            if e == context else f'{get_chars(xlit)}'
-                      for e, xlit in enumerate(formctx.split('|')))
+    return ' | '.join(f'<< {xlit} >>'
+            if e == context else xlit
+                      for e, xlit in enumerate(
+                              get_chars_many(formctx.split('|'))))
 
 def make_lem_src(form, xposctx):
     """ Format XPOS context for training data """
@@ -140,3 +368,37 @@ def make_lem_src(form, xposctx):
     return f'{xlit} {xpos}'
 
 
+def check_tokenizer(*filenames):
+    """ Check that get_chars() gives the same output as the
+    reference implementation for all forms in CoNLL-U files
+    with each tokenizer setting; returns number of differences """
+    forms = set()
+    for filename in filenames:
+        with open(filename, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip() and not line.startswith('#'):
+                    fields = line.rstrip('\n').split('\t')
+                    if len(fields) > 1:
+                        forms.add(fields[1])
+
+    setting = Tokenizer.setting
+    errors = 0
+    for tokenizer in (0, 1, 2):
+        Tokenizer.setting = tokenizer
+        get_chars.cache_clear()
+        reformat.cache_clear()
+        for form in sorted(forms):
+            expected = get_chars_reference(form)
+            if get_chars(form) != expected:
+                errors += 1
+                print(f'> Tokenizer {Tokenizer.setting}: {form} -> '\
+                      f'{get_chars(form)} != {expected}')
+    Tokenizer.setting = setting
+    print(f'> Checked {len(forms)} forms: {errors} differences')
+    return errors
+
+
+if __name__ == "__main__":
+    """ Usage: python preprocessing.py file.conllu [...] """
+    import sys
+    check_tokenizer(*sys.argv[1:])
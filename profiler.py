@@ -0,0 +1,196 @@
+import os
+import time
+import json
+import atexit
+import threading
+import functools
+import cProfile
+import contextlib
+import tracemalloc
+import multiprocessing
+from collections import defaultdict
+
+""" ===========================================================
+Lightweight instrumentation for BabyLemmatizer
+
+Pipeline steps are wrapped in timed spans (see span() and timed())
+and interesting quantities are counted with count(). Nothing is
+recorded unless profiling is enabled with --profile=<file> or by
+setting the environment variable
+
+   BABYLEMMATIZER_PROFILE=<file>
+
+The trace is written when the program exits. Files ending with
+.jsonl get one JSON object per span and a final object with the
+counters; other files are written in Chrome trace format, which
+can be opened in chrome://tracing or https://ui.perfetto.dev.
+
+Optional extras (also as --profile-python and --profile-memory):
+
+   BABYLEMMATIZER_PROFILE_PYTHON=1    cProfile the whole run into
+                                      <file>.prof (see pstats)
+   BABYLEMMATIZER_PROFILE_MEMORY=1    record traced memory use of
+                                      each span with tracemalloc
+
+=========================================================== """
+
+ENV_PROFILE = 'BABYLEMMATIZER_PROFILE'
+ENV_PYTHON = 'BABYLEMMATIZER_PROFILE_PYTHON'
+ENV_MEMORY = 'BABYLEMMATIZER_PROFILE_MEMORY'
+
+enabled = False
+output = None
+memory = False
+events = []
+counters = defaultdict(int)
+lock = threading.Lock()
+_python_profiler = None
+_start = time.perf_counter()
+
+""" Callables that return extra counters when the trace is written """
+_sources = []
+
+
+def enable(filename, python=False, memory_use=False):
+    """ Start recording spans and counters into `filename`
+
+    :param filename        trace file (.jsonl or Chrome trace)
+    :param python          run cProfile and save <filename>.prof
+    :param memory_use      record memory use with tracemalloc
+
+    :type filename         str / path
+    :type python           bool
+    :type memory_use       bool """
+
+    global enabled, output, memory, _python_profiler
+    if enabled:
+        return
+    enabled = True
+    output = filename
+    atexit.register(write)
+
+    if memory_use:
+        tracemalloc.start()
+        memory = True
+
+    if python:
+        _python_profiler = cProfile.Profile()
+        _python_profiler.enable()
+
+    print(f'> Profiling into {filename}')
+
+
+def enable_from_env():
+    """ Enable profiling if the environment variable is set;
+    worker processes inherit the variable but are not traced """
+    filename = os.environ.get(ENV_PROFILE)
+    if filename and multiprocessing.parent_process() is None:
+        enable(filename,
+               python=bool(os.environ.get(ENV_PYTHON)),
+               memory_use=bool(os.environ.get(ENV_MEMORY)))
+
+
+def register(source):
+    """ Register a callable that returns a dictionary of counters;
+    it is called when the trace is written """
+    _sources.append(source)
+
+
+def count(name, n=1):
+    """ Increment counter `name` by `n` """
+    if enabled:
+        with lock:
+            counters[name] += n
+
+
+@contextlib.contextmanager
+def _span(name, args):
+    if memory:
+        mem_start = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    try:
+        yield args
+    finally:
+        end = time.perf_counter()
+        if memory:
+            current, peak = tracemalloc.get_traced_memory()
+            args['memory'] = current - mem_start
+            args['memory_peak'] = peak
+        event = {'name': name,
+                 'start': start - _start,
+                 'duration': end - start,
+                 'pid': os.getpid(),
+                 'tid': threading.get_ident(),
+                 'args': args}
+        with lock:
+            events.append(event)
+
+
+def span(name, **args):
+    """ Context manager that records the wall time of a block.
+    Yields a dictionary of span arguments that the block may
+    add to, e.g. the number of processed words. """
+    if not enabled:
+        return contextlib.nullcontext({})
+    return _span(name, args)
+
+
+def timed(name):
+    """ Decorator that records each call of a function as a span """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            with _span(name, {}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _chrome_trace():
+    """ Spans and counters in Chrome trace event format """
+    trace = []
+    for event in events:
+        trace.append({'name': event['name'],
+                      'cat': event['name'].split('.')[0],
+                      'ph': 'X',
+                      'ts': round(event['start'] * 1e6, 1),
+                      'dur': round(event['duration'] * 1e6, 1),
+                      'pid': event['pid'],
+                      'tid': event['tid'],
+                      'args': event['args']})
+    end = round((time.perf_counter() - _start) * 1e6, 1)
+    for name, value in sorted(counters.items()):
+        trace.append({'name': name, 'ph': 'C', 'ts': end,
+                      'pid': os.getpid(), 'args': {name: value}})
+    return {'traceEvents': trace, 'displayTimeUnit': 'ms'}
+
+
+def write():
+    """ Write trace and profiles; called at exit """
+    if not enabled:
+        return
+
+    if _python_profiler is not None:
+        _python_profiler.disable()
+        _python_profiler.dump_stats(output + '.prof')
+        print(f'> Python profile saved to {output}.prof')
+
+    for source in _sources:
+        for name, value in source().items():
+            counters[name] = value
+
+    with open(output, 'w', encoding='utf-8') as f:
+        if output.endswith('.jsonl'):
+            for event in events:
+                f.write(json.dumps(event, ensure_ascii=False) + '\n')
+            f.write(json.dumps({'counters': dict(counters)},
+                               ensure_ascii=False) + '\n')
+        else:
+            json.dump(_chrome_trace(), f, ensure_ascii=False)
+
+    print(f'> Profiling trace saved to {output}')
+
+
+enable_from_env()
@@ -0,0 +1,165 @@
+import os
+import time
+import subprocess
+
+""" ===========================================================
+Local job scheduler for BabyLemmatizer 2
+
+Runs shell command jobs (e.g. OpenNMT build_vocab.py + train.py
+for each network) concurrently within a budget of CPU slots.
+Each job reserves as many slots as it uses threads. Failed
+commands are retried, and the output of each job is written
+into its own log file.
+
+=========================================================== """
+
+
+class Job:
+
+    """ Sequence of shell commands run one after another
+
+    :param name            job name shown in messages
+    :param commands        shell commands
+    :param threads         number of CPU slots the job uses
+    :param log_file        file for stdout and stderr of the job
+
+    :type name             str
+    :type commands         list of str
+    :type threads          int
+    :type log_file         str / path """
+
+    def __init__(self, name, commands, threads=1, log_file=None):
+        self.name = name
+        self.commands = commands
+        self.threads = threads
+        self.log_file = log_file
+        self.step = 0
+        self.attempt = 0
+        self.process = None
+        self.log = None
+        self.started = None
+        self.returncode = None
+
+
+    @property
+    def done(self):
+        return self.step == len(self.commands)
+
+
+class Scheduler:
+
+    """ Run jobs concurrently with a CPU slot budget
+
+    :param slots           number of CPU slots, e.g. cores
+    :param retries         how many times a failed command is retried
+    :param interval        seconds between process polls
+
+    :type slots            int
+    :type retries          int
+    :type interval         float """
+
+    def __init__(self, slots=None, retries=1, interval=1.0):
+        if slots is None:
+            slots = os.cpu_count() or 1
+        self.slots = slots
+        self.retries = retries
+        self.interval = interval
+
+
+    def _start(self, job):
+        """ Start the current command of the job """
+        command = job.commands[job.step]
+        if job.log is None:
+            if job.log_file is not None:
+                job.log = open(job.log_file, 'a', encoding='utf-8')
+            else:
+                job.log = subprocess.DEVNULL
+
+        if job.log is not subprocess.DEVNULL:
+            job.log.write(f'> {time.strftime("%Y-%m-%d %H:%M:%S")} '\
+                          f'attempt {job.attempt + 1}: {command}\n')
+            job.log.flush()
+
+        env = dict(os.environ,
+                   OMP_NUM_THREADS=str(job.threads),
+                   MKL_NUM_THREADS=str(job.threads))
+        job.process = subprocess.Popen(
+            command, shell=True, env=env,
+            stdout=job.log, stderr=subprocess.STDOUT)
+
+
+    def _finish(self, job, returncode):
+        if job.log is not subprocess.DEVNULL:
+            job.log.close()
+        job.log = None
+        job.process = None
+        job.returncode = returncode
+        elapsed = round(time.time() - job.started)
+        status = 'finished' if returncode == 0 else f'FAILED ({returncode})'
+        print(f'> [{job.name}] {status} in {elapsed} s')
+
+
+    def _poll(self, job):
+        """ Check the job; returns True if it is finished """
+        returncode = job.process.poll()
+        if returncode is None:
+            return False
+
+        if returncode == 0:
+            job.step += 1
+            job.attempt = 0
+            if job.done:
+                self._finish(job, 0)
+                return True
+        elif job.attempt < self.retries:
+            job.attempt += 1
+            print(f'> [{job.name}] command failed ({returncode}), '\
+                  f'retry {job.attempt}/{self.retries}')
+        else:
+            self._finish(job, returncode)
+            return True
+
+        self._start(job)
+        return False
+
+
+    def run(self, jobs):
+        """ Run jobs and wait until all of them are finished.
+        Jobs are started in the given order whenever enough slots
+        are free; a job that does not fit does not block smaller
+        jobs behind it.
+
+        :param jobs            jobs to run
+        :type jobs             list of Job
+
+        Returns dictionary of job names and return codes. """
+
+        pending = list(jobs)
+        running = []
+        for job in pending:
+            job.threads = max(1, min(job.threads, self.slots))
+
+        print(f'> Running {len(pending)} jobs in {self.slots} CPU slots')
+        try:
+            while pending or running:
+                free = self.slots - sum(job.threads for job in running)
+                for job in list(pending):
+                    if job.threads <= free:
+                        pending.remove(job)
+                        running.append(job)
+                        free -= job.threads
+                        job.started = time.time()
+                        print(f'> [{job.name}] started ({job.threads} threads)')
+                        self._start(job)
+
+                time.sleep(self.interval)
+                for job in list(running):
+                    if self._poll(job):
+                        running.remove(job)
+        finally:
+            for job in running:
+                if job.process is not None:
+                    job.process.terminate()
+                    self._finish(job, job.process.wait())
+
+        return {job.name: job.returncode for job in jobs}
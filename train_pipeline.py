@@ -6,13 +6,19 @@ import sys
 import math
 import shutil
 import re
-from collections import defaultdict
-from preferences import python_path, onmt_path, Paths, Tokenizer, Context, __version__
+import json
+import hashlib
+from collections import defaultdict, Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from preferences import python_path, onmt_path, Paths, Tokenizer, Context, Cache, Training, __version__
 from command_parser import parse_prefix, split_train_filename
 import preprocessing as PP
 import conllutools
 import conlluplus
 import base_yaml
+import postprocess
+import profiler
+from scheduler import Job, Scheduler
 
 """ ===========================================================
 Training data builder and trainer for BabyLemmatizer 2
@@ -30,6 +36,13 @@ statistics = defaultdict(int)
 counts = defaultdict(dict)
 log = []
 
+""" Version of the training data format; increase when the output
+of _make_training_data() changes so that old builds are redone """
+BUILD_VERSION = 1
+
+""" Build manifest in the model directory, see _make_training_data() """
+MANIFEST = 'manifest.json'
+
 def logger(message):
     print(message)
     log.append(message)
@@ -42,6 +55,115 @@ def save_log(log_file):
     print(f'\n> Log saved to {log_file}')
 
 
+def _init_job(settings):
+    """ Copy build settings of the main process into a worker """
+    (Paths.conllu, Paths.models, Tokenizer.setting,
+     Context.tagger_context, Context.lemmatizer_context,
+     Cache.tokens, Cache.max_tokens) = settings
+
+
+def _build_job(filename):
+    """ Build training data from one file in a worker process;
+    returns its statistics, counts, log lines and manifest entry """
+    statistics.clear()
+    counts.clear()
+    log.clear()
+    entry = _make_training_data(filename, setup=False, record=False)
+    return dict(statistics), dict(counts), list(log), (filename, entry)
+
+
+def _merge_job(result):
+    """ Merge results of a worker into the module state """
+    job_statistics, job_counts, job_log, (filename, entry) = result
+    statistics.update(job_statistics)
+    for prefix, stats in job_counts.items():
+        counts.setdefault(prefix, {}).update(stats)
+    log.extend(job_log)
+    prefix, data_type = split_train_filename(os.path.split(filename)[-1])
+    _record(prefix, 'data', data_type, entry)
+
+
+def _file_hash(*filenames):
+    """ Hash contents of files """
+    digest = hashlib.blake2b(digest_size=16)
+    for filename in filenames:
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def _load_manifest(prefix):
+    filename = os.path.join(Paths.models, prefix, MANIFEST)
+    try:
+        with open(filename, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _record(prefix, section, name, entry):
+    """ Update manifest entry; the file is replaced atomically so
+    that concurrent readers never see a partial file """
+    manifest = _load_manifest(prefix)
+    manifest.setdefault(section, {})[name] = entry
+    filename = os.path.join(Paths.models, prefix, MANIFEST)
+    with open(filename + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(filename + '.tmp', filename)
+
+
+def _outputs(prefix, data_type):
+    """ Files written by _make_training_data() and make_lexicon(),
+    relative to the model directory """
+    outputs = [f'conllu/{data_type}.conllu',
+               f'tagger/traindata/{data_type}.src',
+               f'tagger/traindata/{data_type}.tgt',
+               f'lemmatizer/traindata/{data_type}.src',
+               f'lemmatizer/traindata/{data_type}.tgt',
+               f'lex/{data_type}.all',
+               f'lex/{data_type}-types.lem',
+               f'lex/{data_type}-types.xlit']
+    if data_type == 'train':
+        outputs += ['tagger.yaml', 'lemmatizer.yaml']
+    return outputs
+
+
+def _output_sizes(prefix, data_type):
+    """ Sizes of output files; None for missing files """
+    sizes = {}
+    for output in _outputs(prefix, data_type):
+        filename = os.path.join(Paths.models, prefix, output)
+        sizes[output] = os.path.getsize(filename)\
+                        if os.path.isfile(filename) else None
+    return sizes
+
+
+def _build_inputs(filename):
+    """ Everything the training data of a file depends on """
+    return {'source': _file_hash(filename),
+            'tokenizer': Tokenizer.setting,
+            'tagger_context': Context.tagger_context,
+            'lemmatizer_context': Context.lemmatizer_context,
+            'babylemmatizer': __version__,
+            'build': BUILD_VERSION,
+            'tokenizer_version': PP.TOKENIZER_VERSION}
+
+
+def _read_counts(prefix, data_type):
+    """ Read type counts of make_lexicon() from the lexicon files """
+    stats = {}
+    for word_type in ('lem', 'xlit'):
+        stats[word_type] = defaultdict(int)
+        fn = os.path.join(
+            Paths.models, prefix, 'lex', f'{data_type}-types.{word_type}')
+        with open(fn, 'r', encoding='utf-8') as f:
+            for line in f:
+                word, freq = line.rstrip('\n').rsplit('\t', 1)
+                stats[word_type][word] = int(freq)
+    return stats
+
+
 def print_statistics():
     logger('> Training data item counts:')
     for k, v in statistics.items():
@@ -112,6 +234,7 @@ def print_oov_rates():
             logger('   {: <20} {:>7} {:>7} {:>7}'.format(key, *values))           
            
 
+@profiler.timed('train.make_lexicon')
 def make_lexicon(prefix, data_type, filename):
     """ Setup lexicon """
     ### TODO: rewrite this, uses still old conllu module
@@ -155,22 +278,9 @@ def make_lexicon(prefix, data_type, filename):
         counts[prefix][data_type] = stats
 
 
-def _make_training_data(filename):
-    """ Build training data for POS-tagger and lemmatizer.
-    The data is saved to `TRAIN_PATH`. Source files must be
-    in CONLL-U format and named PREFIX-SUFFIX.conllu, where
-    prefix is arbitrary identifier and suffix `dev`, `test`,
-    or `train` depending on which set the data belongs. """
-
-    #context = Context.pos_context
-    
-    """ Create required folder structures for the model """
-    orig_fn = os.path.split(filename)[-1]
-    prefix, data_type = split_train_filename(orig_fn)
-    
-    logger(f'\n> Building training data from {filename}')
-
-    """ Define model path structure """
+def _setup_model(prefix):
+    """ Create required folder structures, config and override
+    file for the model """
     ## TODO: makedirs
     paths = (
         Paths.models,
@@ -196,6 +306,61 @@ def _make_training_data(filename):
         conffile.write(f'tokenizer: {Tokenizer.setting}\n')
         conffile.write(f'tagger_context: {Context.tagger_context}\n')
         conffile.write(f'lemmatizer_context: {Context.lemmatizer_context}\n')
+
+    """ Create override file """
+    if not os.path.isfile(_override_file(prefix)):
+        _reset_override(prefix)
+
+
+def _override_file(prefix):
+    return os.path.join(Paths.models, prefix, 'override', 'override.conllu')
+
+
+def _reset_override(prefix):
+    with open(_override_file(prefix), 'w', encoding='utf-8') as f:
+        f.write(f'## BabyLemmatizer {__version__} Override\n')
+
+
+@profiler.timed('train.make_training_data')
+def _make_training_data(filename, setup=True, record=True):
+    """ Build training data for POS-tagger and lemmatizer.
+    The data is saved to `TRAIN_PATH`. Source files must be
+    in CONLL-U format and named PREFIX-SUFFIX.conllu, where
+    prefix is arbitrary identifier and suffix `dev`, `test`,
+    or `train` depending on which set the data belongs.
+    If `setup` is False, the model directory must already
+    exist (see _setup_model()).
+
+    The inputs (source file hash, tokenizer and context settings,
+    versions) and outputs of each build are recorded in the model
+    manifest. If they are unchanged, the build is skipped and only
+    its statistics are restored. With `record` False, the manifest
+    entry is returned but not saved. """
+
+    #context = Context.pos_context
+    
+    """ Create required folder structures for the model """
+    orig_fn = os.path.split(filename)[-1]
+    prefix, data_type = split_train_filename(orig_fn)
+    
+    logger(f'\n> Building training data from {filename}')
+
+    if setup:
+        _setup_model(prefix)
+
+    inputs = _build_inputs(filename)
+    entry = _load_manifest(prefix).get('data', {}).get(data_type)
+    if entry is not None and entry['inputs'] == inputs\
+       and entry['outputs'] == _output_sizes(prefix, data_type):
+        logger('   + Inputs unchanged, using existing training data')
+        statistics[filename] = entry['examples']
+        counts.setdefault(prefix, {})[data_type] =\
+            _read_counts(prefix, data_type)
+        return entry
+    
+    """ Override entries refer to the old training data """
+    if data_type == 'train':
+        _reset_override(prefix)
     
     """ Load CoNLL-U+ file """
     this_data = conlluplus.ConlluPlus(filename)
@@ -217,12 +382,6 @@ def _make_training_data(filename):
             field = 'formctx',
             values = this_data.get_contexts('form', size=Context.tagger_context))
     
-
-    """ Create override file """
-    with open(os.path.join(Paths.models, prefix, 'override', 'override.conllu'),\
-              'w', encoding='utf-8') as f:
-        f.write(f'## BabyLemmatizer {__version__} Override\n')
-    
     """ Save this data to the model directory for reproducibility and
     ease of use """
     conllu_ext = os.path.join(Paths.models, prefix, 'conllu', f'{data_type}.conllu')
@@ -299,17 +458,31 @@ def _make_training_data(filename):
 
     make_lexicon(prefix, data_type, filename)
 
+    entry = {'inputs': inputs,
+             'examples': statistics[filename],
+             'outputs': _output_sizes(prefix, data_type)}
+    if record:
+        _record(prefix, 'data', data_type, entry)
+    return entry
 
-def build_train_data(*models):
+
+@profiler.timed('train.build_train_data')
+def build_train_data(*models, jobs=1):
     """ Build train data from CoNLL-U files in the given
     folder.
 
     :param models         arbitrary number of model names that
                           correspond to file prefixes in the conllu path
     :param conllu_path    location of CoNLL-U files
+    :param jobs           number of files built in parallel
 
     :type models          str
-    :type models          str                        """
+    :type models          str
+    :type jobs            int
+
+    With several jobs, the files (e.g. folds of a cross-validation
+    set) are built in separate processes whose statistics, counts
+    and log lines are merged in file order afterwards. """
     
     filelist = [x for x in os.listdir(Paths.conllu)
                 if x.endswith('.conllu') and x.startswith(tuple(models))]
@@ -318,8 +491,37 @@ def build_train_data(*models):
         print(f'\n> Path "{Path.conllu}" does not contain'\
               ' files with given prefix')
     
-    for filename in sorted(filelist):
-        _make_training_data(os.path.join(Paths.conllu, filename))
+    prefixes = sorted(set(split_train_filename(x)[0] for x in filelist))
+    filenames = [os.path.join(Paths.conllu, filename)
+                 for filename in sorted(filelist)]
+
+    if jobs > 1 and len(filenames) > 1:
+        for prefix in prefixes:
+            _setup_model(prefix)
+
+        settings = (Paths.conllu, Paths.models, Tokenizer.setting,
+                    Context.tagger_context, Context.lemmatizer_context,
+                    Cache.tokens, Cache.max_tokens)
+        jobs = min(jobs, len(filenames))
+        print(f'> Building {len(filenames)} files in {jobs} processes')
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_job,
+                                 initargs=(settings,)) as executor:
+            for result in executor.map(_build_job, filenames):
+                _merge_job(result)
+
+            """ Compile post-processing lexicons of the built models """
+            lexicons = [prefix for prefix in prefixes if os.path.isfile(
+                os.path.join(Paths.models, prefix, 'conllu', 'train.conllu'))]
+            list(executor.map(postprocess.update_lexicon, lexicons))
+    else:
+        for filename in filenames:
+            _make_training_data(filename)
+
+        """ Compile post-processing lexicons of the built models """
+        for prefix in prefixes:
+            if os.path.isfile(os.path.join(
+                    Paths.models, prefix, 'conllu', 'train.conllu')):
+                postprocess.update_lexicon(prefix)
         
     print_statistics()
     print_oov_rates()
@@ -333,22 +535,90 @@ def build_train_data(*models):
     save_log(f'build-log-{prefix}.txt')
 
 
-def train_model(*models, cpu=False):
+def count_tokens(filename):
+    """ Count space separated tokens of a file, reading it in
+    blocks of lines """
+    counter = Counter()
+    with open(filename, 'r', encoding='utf-8') as f:
+        for lines in iter(lambda: f.readlines(1 << 20), []):
+            counter.update(''.join(lines).split())
+    return counter
+
+
+def build_shared_vocab(*models, threads=None):
+    """ Build the union vocabulary of the training sets of all
+    models (e.g. cross-validation folds) and write it as
+    vocab.src/vocab.tgt of each model in the format of OpenNMT
+    build_vocab.py, i.e. tokens with counts, most common first.
+
+    :param models         model names
+    :param threads        number of files read in parallel
+
+    :type models          str
+    :type threads         int or None """
+
+    for component in ('tagger', 'lemmatizer'):
+        for ext in ('src', 'tgt'):
+            filenames = [os.path.join(Paths.models, model, component,
+                                      'traindata', f'train.{ext}')
+                         for model in sorted(models)]
+            with ThreadPoolExecutor(threads) as executor:
+                vocab = Counter()
+                for counter in executor.map(count_tokens, filenames):
+                    vocab.update(counter)
+
+            content = ''.join(f'{token}\t{freq}\n'
+                              for token, freq in vocab.most_common())
+            for model in models:
+                with open(os.path.join(Paths.models, model, component,
+                                       f'vocab.{ext}'),
+                          'w', encoding='utf-8') as f:
+                    f.write(content)
+            print(f'> Shared {component} vocab.{ext}: {len(vocab)} tokens '\
+                  f'from {len(filenames)} models')
+
+
+@profiler.timed('train.train_model')
+def train_model(*models, cpu=False, slots=None, threads=None,
+                shared_vocab=False):
     """ Run this method to train the models; this simply calls OpenNMT
     from the command line with required parameters to train basic
     models for raw tagging and lemmatization.
 
+    The tagger and lemmatizer of every model are independent jobs
+    that are run concurrently by a scheduler within a budget of
+    CPU slots (on GPU, `slots` is the number of concurrent jobs).
+    Failed commands are retried Training.retries times, and the
+    output of each job is written to <model>/<component>/train.log.
+
     :param models         arbitrary number of model names that
                           correspond to file prefixes in the conllu path
+    :param slots          CPU slots, see Training.slots
+    :param threads        threads per job on CPU, see Training.threads
+    :param shared_vocab   build one union vocabulary for all models
+                          instead of running build_vocab.py for each
 
-    :type models          str """
+    :type models          str
+    :type slots           int or None
+    :type threads         int or None
+    :type shared_vocab    bool """
+
+    if slots is None:
+        slots = Training.slots
+    if threads is None:
+        threads = Training.threads
 
     if cpu:
         gpu = ''
     else:
         gpu = '-gpu_ranks 0 -world_size 1'
+        """ GPU jobs use one slot each """
+        threads = 1
+        if slots is None:
+            slots = 1
 
-        
+    jobs = {}
+    vocab_keys = {}
     for model in sorted(models):
         if model not in os.listdir(Paths.models):            
             print(f'> Run build_training_data({model}) before training.')
@@ -357,13 +627,52 @@ def train_model(*models, cpu=False):
         ## TODO: use os.path.join instead of string formatting
         model_path = os.path.join(Paths.models, model)
 
-        for yaml in (x for x in os.listdir(model_path) if x.endswith('.yaml')):
-            os.system(f'{python_path}python {onmt_path}build_vocab.py '\
-                      f'-config {model_path}/{yaml} -n_sample -1 '\
-                      f'-num_threads 2')
-            os.system(f'{python_path}python {onmt_path}train.py '\
-                      f'-config {model_path}/{yaml} {gpu}')
-            pass
+        manifest = _load_manifest(model)
+        for component in ('tagger', 'lemmatizer'):
+            yaml = f'{model_path}/{component}.yaml'
+
+            """ Vocabulary depends only on the YAML and training set """
+            vocab_key = _file_hash(
+                yaml, *(os.path.join(model_path, component, 'traindata',
+                                     f'train.{ext}') for ext in ('src', 'tgt')))
+            commands = []
+            if shared_vocab:
+                """ Shared vocabulary depends on other models too """
+                vocab_key = 'shared'
+            elif manifest.get('vocab', {}).get(component) == vocab_key\
+               and all(os.path.isfile(os.path.join(
+                   model_path, component, f'vocab.{ext}'))
+                       for ext in ('src', 'tgt')):
+                print(f'> Vocabulary of {model} {component} is up to date')
+            else:
+                commands.append(
+                    f'{python_path}python {onmt_path}build_vocab.py '\
+                    f'-config {yaml} -n_sample -1 '\
+                    f'-num_threads 2')
+            vocab_keys[(model, component)] = vocab_key
+            commands.append(
+                f'{python_path}python {onmt_path}train.py '\
+                f'-config {yaml} {gpu}')
+            jobs[(model, component)] = Job(
+                f'{model} {component}', commands, threads,
+                os.path.join(model_path, component, 'train.log'))
+
+    if shared_vocab:
+        build_shared_vocab(*models, threads=slots)
+
+    results = Scheduler(slots, Training.retries).run(list(jobs.values()))
+    for (model, component), job in jobs.items():
+        if results[job.name] == 0:
+            _record(model, 'vocab', component, vocab_keys[(model, component)])
+
+    for model in sorted(models):
+        model_path = os.path.join(Paths.models, model)
+        if any(results[jobs[(model, component)].name]
+               for component in ('tagger', 'lemmatizer')):
+            print(f'> Training {model} failed, see train.log files in '\
+                  f'{model_path}')
+            continue
+        
         _rename_model(model, 'lemmatizer')
         _rename_model(model, 'tagger')
 
@@ -24,6 +24,28 @@ def normalize(xlit):
     xlit = preprocessing.subscribe_indices(xlit)
     return xlit
 
+def upl_to_lines(lines):
+    """ Convert unit-per-line text into CoNLL-U lines; see
+    upl_to_conllu() for the input format
+
+    :param lines               lines of text
+    :type lines                iterable of str """
+
+    head = {1: '0'}
+    deprel = {1: 'root'}
+
+    for line in lines:
+        i = 1
+        if line.startswith('#'):
+            yield line
+            continue
+        for word in line.strip().split(' '):
+            hh = head.get(i, '1')
+            rr = deprel.get(i, 'child')
+            yield f'{i}\t{normalize(word)}\t_\t_\t_\t_\t{hh}\t{rr}\t_\t_'
+            i += 1
+        yield ''
+
 def upl_to_conllu(upl_file, output):
     """ Convert unit-per-line format into CoNLL-U
 
@@ -38,23 +60,11 @@ def upl_to_conllu(upl_file, output):
  
     """
 
-    head = {1: '0'}
-    deprel = {1: 'root'}
-
     with open(upl_file, 'r', encoding='utf-8') as f,\
          open(output, 'w', encoding='utf-8') as o:
 
-        for line in f.read().splitlines():
-            i = 1
-            if line.startswith('#'):
-                o.write(line + '\n')
-                continue
-            for word in line.strip().split(' '):
-                hh = head.get(i, '1')
-                rr = deprel.get(i, 'child')
-                o.write(f'{i}\t{normalize(word)}\t_\t_\t_\t_\t{hh}\t{rr}\t_\t_\n')
-                i += 1
-            o.write('\n')
+        for line in upl_to_lines(f.read().splitlines()):
+            o.write(line + '\n')
 
     print(f'> File converted to CoNLL-U+ and saved as {output}')
 
@@ -1,5 +1,7 @@
 import os
 import re
+import random
+import hashlib
 from collections import defaultdict
 from metadata import PERIODS, WORDLANGS, TEXTLANGS, LANG_TO_PERIOD, POSMAP
 
@@ -234,43 +236,175 @@ def n_fold_split(n, data):
     return train_data, test_data, dev_data
 
 
-def make_training_sets(file):
-    set_units = set()
-    units = []
-    this_unit = []
-    removed = 0
+def read_units(file):
+    """ Stream units (lists of lines ending with an empty line)
+    from a CoNLL-U file without reading it into memory """
+    unit = []
     with open(file, 'r', encoding='utf-8') as source:
-        for line in source.read().splitlines():
-            this_unit.append(line)
+        for line in source:
+            line = line.rstrip('\n')
+            unit.append(line)
             if not line:
-                """ Remove duplicates """
-                if len(this_unit) > 12 and tuple(this_unit) in set_units:
-                    
-                    removed += 1
-                    print(removed, len(this_unit))
-                    this_unit = []
-                    continue
-                
-                units.append(tuple(this_unit))
-                set_units.add(tuple(this_unit))
-                this_unit = []
+                yield unit
+                unit = []
+
 
-    train, dev, test = n_fold_split(10, units)
+def segment_hash(unit):
+    """ 128-bit hash of normalized unit content """
+    content = '\n'.join(line.strip() for line in unit if line.strip())
+    return hashlib.blake2b(content.encode('utf-8'), digest_size=16).digest()
+
+
+class MinHash:
+
+    """ Near-duplicate detection with MinHash signatures over sign
+    n-grams of the forms and locality-sensitive hashing. A unit is a
+    near duplicate if any band of its signature equals a band of an
+    earlier unit; with `bands` x `rows` permutations this happens
+    mostly above Jaccard similarity (1/bands)^(1/rows), 0.77 for
+    8 x 8. Only band hashes are kept in memory.
+
+    :param ngram           sign n-gram size
+    :param bands           number of LSH bands
+    :param rows            permutations per band
+    :param seed            random seed for the permutations
+
+    :type ngram            int
+    :type bands            int
+    :type rows             int
+    :type seed             int """
+
+    PRIME = (1 << 61) - 1
+
+    def __init__(self, ngram=3, bands=8, rows=8, seed=1):
+        self.ngram = ngram
+        self.bands = bands
+        self.rows = rows
+        rng = random.Random(seed)
+        self.permutations = [(rng.randrange(1, self.PRIME),
+                              rng.randrange(0, self.PRIME))
+                             for _ in range(bands * rows)]
+        self.seen = [set() for _ in range(bands)]
+
+
+    def shingles(self, unit):
+        """ Hashes of sign n-grams of the forms of the unit """
+        signs = []
+        for line in unit:
+            data = line.split('\t')
+            if len(data) > 1 and not line.startswith('#'):
+                signs.extend(re.split(r'[-.\s]+', data[1].lower()))
+                signs.append(' ')
+        grams = {' '.join(signs[i:i+self.ngram])
+                 for i in range(max(1, len(signs) - self.ngram + 1))}
+        return [int.from_bytes(hashlib.blake2b(
+            gram.encode('utf-8'), digest_size=8).digest(), 'little')
+                for gram in grams]
+
+
+    def signature(self, unit):
+        hashes = self.shingles(unit)
+        return [min((a * h + b) % self.PRIME for h in hashes)
+                for a, b in self.permutations]
+
+
+    def is_duplicate(self, unit):
+        """ Check whether the unit is a near duplicate of an earlier
+        unit and remember it """
+        signature = self.signature(unit)
+        keys = [hashlib.blake2b(
+            str(signature[i*self.rows:(i+1)*self.rows]).encode('ascii'),
+            digest_size=8).digest() for i in range(self.bands)]
+        duplicate = any(key in seen for key, seen in zip(keys, self.seen))
+        for key, seen in zip(keys, self.seen):
+            seen.add(key)
+        return duplicate
+
+
+def deduplicate(units, min_length=12, near_duplicates=False):
+    """ Remove duplicate units from a stream of units. Only 128-bit
+    hashes of seen units are kept in memory.
+
+    :param units           units, see read_units()
+    :param min_length      deduplicate only units with more lines
+    :param near_duplicates remove also near duplicates (MinHash)
+
+    :type units            iterable of lists
+    :type min_length       int
+    :type near_duplicates  bool or MinHash """
+
+    seen = set()
+    if near_duplicates is True:
+        near_duplicates = MinHash()
+    removed = 0
+    for unit in units:
+        if len(unit) > min_length:
+            key = segment_hash(unit)
+            if key in seen or (near_duplicates and\
+                               near_duplicates.is_duplicate(unit)):
+                removed += 1
+                continue
+            seen.add(key)
+        yield unit
+    print(f'> Removed {removed} duplicate units')
+
+
+def make_training_sets(file, n=10, min_length=12, near_duplicates=False):
+    """ Split a CoNLL-U file into n folds of train/dev/test sets
+    after removing duplicate units. Units are streamed from the
+    source directly into the fold files. Unit e goes to the dev set
+    of split e % n and to the test set of split e % n - 1, as the
+    folds were written from n_fold_split() before.
+
+    :param file            CoNLL-U file
+    :param n               number of folds
+    :param min_length      deduplicate only units with more lines
+    :param near_duplicates remove also near duplicates (MinHash)
+
+    :type file             str / path
+    :type n                int
+    :type min_length       int
+    :type near_duplicates  bool """
 
     path, fn = os.path.split(file)
 
     fn = fn.split('.')[0]
-    
-    for n in range(0,10):
-        number = str(n)
-        prefix = fn + number
-
-        for suffix, dataset in (('train', train), ('dev', dev), ('test', test)):
-            print(suffix, len(dataset[n]))
-            with open(f'{prefix}-{suffix}.conllu', 'w', encoding='utf-8') as out:
-                for unit in dataset[n]:
-                    for line in unit:
-                        out.write(line + '\n')
+
+    files = {}
+    sizes = defaultdict(int)
+    for split in range(0, n):
+        prefix = fn + str(split)
+        for suffix in ('train', 'dev', 'test'):
+            files[(split, suffix)] = open(
+                f'{prefix}-{suffix}.conllu', 'w', encoding='utf-8')
+
+    try:
+        units = deduplicate(read_units(file), min_length, near_duplicates)
+        for e, unit in enumerate(units):
+            text = ''.join(line + '\n' for line in unit)
+            for split in range(0, n):
+                devsplit = split + 1
+                if devsplit == n:
+                    devsplit = 0
+
+                if n == 1:
+                    suffixes = ('train', 'dev', 'test')
+                elif e % n == split:
+                    suffixes = ('dev',)
+                elif e % n == devsplit:
+                    suffixes = ('test',)
+                else:
+                    suffixes = ('train',)
+
+                for suffix in suffixes:
+                    files[(split, suffix)].write(text)
+                    sizes[(split, suffix)] += 1
+    finally:
+        for f in files.values():
+            f.close()
+
+    for (split, suffix), size in sorted(sizes.items()):
+        print(fn + str(split), suffix, size)
         
     
 #make_txt()